@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Content addressed ofx archive
+* Statements are stored once by digest of their content,
+  volatile headers (DTSERVER, TRNUID, file UIDs, statement dates...) excluded
+* Objects are zstd compressed when zstandard is installed, gzip otherwise
+* A manifest by account points at its latest statement
+
+Usage: archive.py DIRECTORY [-c ACCOUNT]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+import ofx
+
+# Elements and headers which change at each download of the same statement,
+# statement dates too: a later window with the same transactions and
+# balances brings nothing new
+VOLATILE_RE = re.compile(r"<(DTSERVER|DTPROFUP|DTACCTUP|TRNUID|DTSTART|DTEND|DTASOF)>"
+                         r"[^<\r\n]*(</\1>)?|"
+                         r"^(OLDFILEUID|NEWFILEUID):.*$|"
+                         r"\b(OLDFILEUID|NEWFILEUID)=\"[^\"]*\"", re.MULTILINE)
+EXTENSIONS = (".ofx.zst", ".ofx.gz")
+
+
+def normalized_parts(chunks):
+    """Yield the parts of a statement read by chunks without its volatile headers
+    Parts are cut before opening tags, so no volatile element spans two parts
+    """
+    buf = ""
+    for chunk in chunks:
+        buf += chunk
+        cut = buf.rfind("<")
+        while cut > 0 and (cut + 1 == len(buf) or buf[cut + 1] == "/"):
+            cut = buf.rfind("<", 0, cut)
+        if cut > 0:
+            yield VOLATILE_RE.sub("", buf[:cut]).replace("\r\n", "\n")
+            buf = buf[cut:]
+    yield VOLATILE_RE.sub("", buf).replace("\r\n", "\n")
+
+def content_digest(content):
+    """Return the sha256 digest of a statement without its volatile headers"""
+    digest = hashlib.sha256()
+    for part in normalized_parts([content]):
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class Archive(object):
+    """Content addressed ofx archive with a manifest by account"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.extension = EXTENSIONS[0] if ofx.zstandard is not None else EXTENSIONS[1]
+        self._lock = threading.Lock()
+        for sub_directory in ("objects", "manifests"):
+            path = os.path.join(directory, sub_directory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def object_name(self, digest, extension=None):
+        """Return the file name of an object"""
+        return os.path.join(self.directory, "objects", digest[:2],
+                            digest + (extension or self.extension))
+
+    def find(self, digest):
+        """Return the file name of a stored object or None"""
+        for extension in EXTENSIONS:
+            file_name = self.object_name(digest, extension)
+            if os.path.exists(file_name):
+                return file_name
+        return None
+
+    def manifest_name(self, account):
+        """Return the manifest file name of an account"""
+        return os.path.join(self.directory, "manifests", account + ".json")
+
+    def manifest(self, account):
+        """Return the manifest of an account, empty if it has none"""
+        try:
+            with open(self.manifest_name(account)) as manifest_file:
+                return json.load(manifest_file)
+        except IOError:
+            return {"account": account, "latest": None, "versions": []}
+
+    def latest(self, account):
+        """Return the file name of the latest statement of an account or None"""
+        digest = self.manifest(account)["latest"]
+        return self.find(digest) if digest is not None else None
+
+    def _store(self, file_name):
+        """Compress a statement in a temporary object while hashing it
+        Return (digest, temporary object file name, statement size)
+        """
+        tmp_file_name = os.path.join(self.directory, "objects",
+                                     "tmp-" + uuid.uuid4().hex + self.extension)
+        digest = hashlib.sha256()
+        sizes = []
+
+        def chunks(in_file, out_file):
+            """Yield the chunks of in_file once written to out_file"""
+            while True:
+                chunk = in_file.read(ofx.CHUNK_SIZE)
+                if not chunk:
+                    return
+                out_file.write(chunk)
+                sizes.append(len(chunk))
+                yield chunk
+
+        with ofx.open_ofx(file_name) as in_file, ofx.create_ofx(tmp_file_name) as out_file:
+            for part in normalized_parts(chunks(in_file, out_file)):
+                digest.update(part)
+        return (digest.hexdigest(), tmp_file_name, sum(sizes))
+
+    def add(self, account, file_name):
+        """Archive a downloaded statement, streamed
+        Return (object file name, False if it is the latest statement already)
+        """
+        digest, tmp_file_name, size = self._store(file_name)
+        with self._lock:
+            object_name = self.find(digest)
+            if object_name is None:
+                object_name = self.object_name(digest)
+                if not os.path.isdir(os.path.dirname(object_name)):
+                    os.makedirs(os.path.dirname(object_name))
+                os.rename(tmp_file_name, object_name)
+            else:
+                os.remove(tmp_file_name)
+            manifest = self.manifest(account)
+            if manifest["latest"] == digest:
+                return (object_name, False)
+            manifest["latest"] = digest
+            manifest["versions"].append({"digest": digest,
+                                         "object": os.path.relpath(object_name,
+                                                                   self.directory),
+                                         "source": os.path.basename(file_name),
+                                         "size": size,
+                                         "archived_at": int(time.time())})
+            tmp_file_name = self.manifest_name(account) + ".tmp"
+            with open(tmp_file_name, "w") as manifest_file:
+                json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+            os.rename(tmp_file_name, self.manifest_name(account))
+        return (object_name, True)
+
+
+def main():
+    """List archived accounts or print the latest statement of an account"""
+    parser = argparse.ArgumentParser(description='Content addressed ofx archive')
+    parser.add_argument('directory')
+    parser.add_argument('-c', '--cat', dest='account', required=False,
+                        help="Print the latest statement of this account")
+    options = parser.parse_args()
+    archive = Archive(options.directory)
+    if options.account is not None:
+        file_name = archive.latest(options.account)
+        if file_name is None:
+            print "No statement for {}".format(options.account)
+            sys.exit(1)
+        sys.stdout.write(ofx.read_ofx(file_name))
+        return
+    for manifest_name in sorted(os.listdir(os.path.join(options.directory, "manifests"))):
+        if not manifest_name.endswith(".json"):
+            continue
+        manifest = archive.manifest(manifest_name[:-len(".json")])
+        last = manifest["versions"][-1]
+        print "{:20s} {} {:3d} version(s), latest {}".format(
+            manifest["account"], manifest["latest"][:12], len(manifest["versions"]),
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(last["archived_at"])))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmarks
+* parse: parse and extract account summaries with many holdings,
+  compared with plain ElementPath extraction on a fully parsed tree
+* flow: run connect, get_accounts and ofx downloads against mockserver.py
+  and report latency, round trips, bytes and parse time by step
+
+Unknown options of the flow benchmark are passed to DesjardinsConnection
+(e.g. bench.py flow -w 2 --since 2015-01-01)
+"""
+
+import argparse
+import os
+from StringIO import StringIO
+import time
+
+from lxml import etree
+
+import desjardins
+import mockserver
+
+
+def legacy_extract(content):
+    """Parse the whole page and extract accounts with uncompiled ElementPath"""
+    tree = etree.parse(StringIO(content), etree.HTMLParser())
+    desjardins.get_errors(tree)
+    accounts = []
+    for panel in tree.findall("//div[@class='panel panel-tiroir']"):
+        title = panel.find("div/h2/a")
+        panel_type = [t.strip() for t in title.itertext() if t.strip() != ''][2]
+        for raw_account in panel.findall("div//div[@class='section tiroir']"):
+            accounts.append((panel_type,
+                             raw_account.find(".//h3").text.strip(),
+                             raw_account.find(".//p/span[@class='desc-ligne2']").text,
+                             raw_account.find(".//p/span[@class='desc-ligne1']").text,
+                             raw_account.find(".//div/span[@class='montant']").text))
+    return accounts
+
+def extract(content):
+    """Extract accounts with the precompiled extraction layer"""
+    page = desjardins.Page(content)
+    desjardins.get_errors(page)
+    return desjardins.parse_accounts(page)
+
+def parse(content):
+    """Only parse the page"""
+    return desjardins.Page(content).tree
+
+def best_time(function, content, runs):
+    """Return the best run time of function in milliseconds"""
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        function(content)
+        timings.append(time.time() - start)
+    return min(timings) * 1000
+
+def bench_parse(options):
+    """Benchmark html extraction"""
+    print "{:>8s} {:>8s} {:>12s} {:>12s} {:>14s}".format(
+        "holdings", "KiB", "parse (ms)", "legacy (ms)", "compiled (ms)")
+    for holdings in options.holdings or [10, 100, 500, 1000]:
+        content = mockserver.make_summary_page(holdings)
+        assert len(extract(content)) == holdings
+        print "{:8d} {:8d} {:12.2f} {:12.2f} {:14.2f}".format(
+            holdings, len(content) / 1024,
+            best_time(parse, content, options.runs),
+            best_time(legacy_extract, content, options.runs),
+            best_time(extract, content, options.runs))
+
+def print_records(name, records, elapsed):
+    """Print requests count, time, bytes and parse time of records"""
+    print "{:18s} {:8d} {:10.1f} {:10.1f} {:10.2f}".format(
+        name, len(records), elapsed * 1000,
+        sum(record["bytes"] for record in records) / 1024.,
+        sum(record["parse_time"] for record in records) * 1000)
+
+def bench_flow(options, connection_args):
+    """Benchmark the login and export flows against the mock server"""
+    server = mockserver.MockServer(("127.0.0.1", 0), options.accounts,
+                                   options.transactions, options.latency)
+    server.start()
+    conn = desjardins.DesjardinsConnection(
+        desjardins.get_args(["--base-url", server.base_url] + connection_args),
+        credentials=mockserver.CREDENTIALS)
+    summary = []
+    steps = [("connect", conn.connect),
+             ("get_accounts", conn.get_accounts),
+             ("list_ofx_account", conn.list_ofx_account),
+             ("download_ofx", lambda: summary.extend(
+                 conn.download_ofx(sorted(conn.accounts))))]
+
+    print "{:18s} {:>8s} {:>10s} {:>10s} {:>10s}".format(
+        "step", "requests", "time (ms)", "KiB", "parse (ms)")
+    start = time.time()
+    for name, step in steps:
+        first_record = len(conn.sessions.history)
+        step_start = time.time()
+        step()
+        print_records(name, conn.sessions.history[first_record:], time.time() - step_start)
+    print_records("total", conn.sessions.history, time.time() - start)
+    print "server: {} requests, {:.1f} KiB sent".format(server.requests,
+                                                         server.bytes_sent / 1024.)
+    for host, stats in sorted(conn.sessions.stats().items()):
+        print "{}: {} handshake(s), {} reused connection(s)".format(
+            host, stats["handshakes"], stats["reused"])
+
+    conn.sessions.close()
+    server.shutdown()
+    server.server_close()
+    for account, file_name, error in summary:
+        if error is not None:
+            print "{} failed: {}".format(account, error)
+        elif conn.options.sync_dir is None:
+            os.remove(file_name)
+
+def get_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    parser_parse = subparsers.add_parser('parse', help="Benchmark html extraction")
+    parser_parse.add_argument('-n', '--holdings', dest='holdings', required=False,
+                              type=int, action='append', default=[],
+                              help="Holdings in the summary page, can be repeated")
+    parser_parse.add_argument('-r', '--runs', dest='runs', required=False,
+                              type=int, default=20)
+    parser_flow = subparsers.add_parser('flow', help="Benchmark the flows on mockserver.py")
+    parser_flow.add_argument('-n', '--accounts', dest='accounts', required=False,
+                             type=int, default=5)
+    parser_flow.add_argument('-t', '--transactions', dest='transactions', required=False,
+                             type=int, default=3,
+                             help="Transactions by day in ofx statements")
+    parser_flow.add_argument('-d', '--latency', dest='latency', required=False,
+                             type=float, default=0.02,
+                             help="Seconds added before each response")
+    return parser.parse_known_args()
+
+def main():
+    """Main function"""
+    options, connection_args = get_args()
+    if options.benchmark == "parse":
+        bench_parse(options)
+    else:
+        bench_flow(options, connection_args)
+
+if __name__ == '__main__':
+    main()
@@ -12,20 +12,81 @@
 #import hashlib
 #import calendar
 import argparse
+import atexit
+from contextlib import contextmanager
 import datetime
+import gzip
+import itertools
+import json
 import logging
-from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+import os
+import random
+import socket
 import sys
+import tempfile
+import threading
+import time
 
 from lxml import etree
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages import urllib3
 
-from settings import questions, secure_phrase, number, password
+from archive import Archive
+from exporter import BalanceCache, ExporterServer
+from influxsink import InfluxDBWriter, make_line
+import ofx
+from recorder import Recorder, Replayer, make_secrets
+from store import TransactionStore
+try:
+    import settings
+except ImportError:
+    # Credentials are then given to DesjardinsConnection (see fleet.py)
+    settings = None
 
 SCHEME = "https://"
 ACCWEB_HOST = "accweb.mouv.desjardins.com"
 ACCESD_HOST = "accesd.mouv.desjardins.com"
 VISA_HOST = "www.scd-desjardins.com"
+RECORD_DIR = "/tmp/desjardins-traffic"
+# Mode of downloaded files, the one open() gives with the process umask
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+# Largest share of --deadline one flow step may use
+STEP_SHARES = {"login": 0.3, "session_probe": 0.1, "sso": 0.2, "accounts": 0.2,
+               "ofx_list": 0.2, "ofx_account": 0.5, "visa_logon": 0.2, "visa": 0.5}
+DETENTION_PATH = "/sommaire-perso/sommaire/detention"
+NETWORK_EXIT_CODE = 9
+INFLUXDB_EXIT_CODE = 10
+EXIT_STATUSES = """exit status:
+  1  an account download failed
+  2  AccesD error page
+  3  no answer for the security question
+  4  secure image unreachable
+  5  credentials refused or website not trusted
+  6  secure image not found
+  7  --deadline exceeded
+  8  host failing, circuit breaker open
+  9  network error after --retries
+  10 InfluxDB points lost or rejected"""
+
+# Precompiled selectors
+XPATH_HIDDEN_INPUTS = etree.XPath("//input[@type='hidden']")
+XPATH_ERRORS = etree.XPath("//span[@id='erreurSystem']")
+XPATH_PANELS = etree.XPath("//div[@class='panel panel-tiroir']")
+XPATH_PANEL_TITLE = etree.XPath("(div/h2/a)[1]")
+XPATH_PANEL_ACCOUNTS = etree.XPath("div//div[@class='section tiroir']")
+XPATH_ACCOUNT_NAME = etree.XPath("(.//h3)[1]")
+XPATH_ACCOUNT_CAISSE = etree.XPath("(.//p/span[@class='desc-ligne2'])[1]")
+XPATH_ACCOUNT_DESCRIPTION = etree.XPath("(.//p/span[@class='desc-ligne1'])[1]")
+XPATH_ACCOUNT_BALANCE = etree.XPath("(.//div/span[@class='montant'])[1]")
+XPATH_OFX_ACCOUNTS = etree.XPath("//input[@type='checkbox']")
+XPATH_OFX_ACCOUNT_NAME = etree.XPath("(../..//td[@class='c'])[1]")
+
+# lxml parsers can not be shared between threads
+_PARSERS = threading.local()
 
 # Get current month
 def get_date():
@@ -37,81 +98,854 @@ def get_date():
     start_date = now - datetime.timedelta(days=30)
     return (start_date, end_date)
 
-def get_args():
+def get_windows(start_date, end_date, days):
+    """Split a date range in windows of at most days days"""
+    windows = []
+    while start_date <= end_date:
+        window_end = min(start_date + datetime.timedelta(days=days - 1), end_date)
+        windows.append((start_date, window_end))
+        start_date = window_end + datetime.timedelta(days=1)
+    return windows
+
+def get_ofx_file_name(account, start_date, end_date, directory="/tmp"):
+    """Get the file name of a downloaded ofx file"""
+    if account == "VISA":
+        return os.path.join(directory, "VISA_" + start_date.strftime("%Y%m%d") + "_" +
+                            end_date.strftime("%Y%m%d") + ".ofx")
+    return os.path.join(directory, account + "_" + start_date.strftime("%Y%m%d") +
+                        "-" + end_date.strftime("%Y%m%d") + ".ofx")
+
+def get_credentials(module):
+    """Return the credentials defined in a settings module"""
+    return {"number": module.number, "password": module.password,
+            "secure_phrase": module.secure_phrase, "questions": module.questions}
+
+def get_since(value):
+    """Parse --since date"""
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("Bad date format, use YYYY-MM-DD")
+
+def get_args(args=None):
     """Parse command line arguments"""
-    parser = argparse.ArgumentParser(description='Process some integers.')
+    parser = argparse.ArgumentParser(description='Process some integers.',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=EXIT_STATUSES)
     parser.add_argument('-l', '--list-accounts', dest='list_accounts', required=False,
                         action='store_true', default=False)
-    parser.add_argument('-a', '--account', dest='account', required=False)
+    parser.add_argument('-a', '--account', dest='account', required=False,
+                        action='append', default=[],
+                        help="Account to download, can be repeated")
+    parser.add_argument('-A', '--all-accounts', dest='all_accounts', required=False,
+                        action='store_true', default=False,
+                        help="Download all accounts")
     parser.add_argument('-i', '--influxdb', dest='influxdb', required=False,
                         action='store_true', default=False)
     parser.add_argument('-L', '--log-level', dest='log_level', required=False,
                         default="FATAL")
     parser.add_argument('-H', '--log-html', dest='log_html', required=False,
-                        action="store_true", default=False)
-    return parser.parse_args()
+                        action="store_true", default=False,
+                        help="Record requests and responses in " + RECORD_DIR)
+    parser.add_argument('-R', '--record', dest='record', required=False,
+                        help="Record requests and responses in this directory")
+    parser.add_argument('--replay', dest='replay', required=False,
+                        help="Serve responses from a recorded file or directory "
+                             "instead of the network")
+    parser.add_argument('--pool-size', dest='pool_size', required=False,
+                        type=int, default=2,
+                        help="Kept-alive connections by host")
+    parser.add_argument('--connect-timeout', dest='connect_timeout', required=False,
+                        type=float, default=10,
+                        help="Connection timeout in seconds")
+    parser.add_argument('--read-timeout', dest='read_timeout', required=False,
+                        type=float, default=30,
+                        help="Read timeout in seconds")
+    parser.add_argument('--deadline', dest='deadline', required=False,
+                        type=float, default=600,
+                        help="Seconds a run can take, each poll in daemon mode, "
+                             "0 for no deadline")
+    parser.add_argument('--retries', dest='retries', required=False,
+                        type=int, default=2,
+                        help="Retries of a failed GET request")
+    parser.add_argument('--retry-budget', dest='retry_budget', required=False,
+                        type=int, default=10,
+                        help="Retries of all requests of a run")
+    parser.add_argument('-w', '--workers', dest='workers', required=False,
+                        type=int, default=1,
+                        help="Download bank and VISA accounts concurrently "
+                             "with up to this many workers")
+    parser.add_argument('-S', '--sync-dir', dest='sync_dir', required=False,
+                        help="Only download new transactions and merge them "
+                             "in one ofx file by account in this directory")
+    parser.add_argument('--overlap', dest='overlap', required=False,
+                        type=int, default=3,
+                        help="Days downloaded again before the last synced transaction")
+    parser.add_argument('--since', dest='since', required=False,
+                        type=get_since, default=None,
+                        help="Download transactions since this date (YYYY-MM-DD)")
+    parser.add_argument('--window-days', dest='window_days', required=False,
+                        type=int, default=90,
+                        help="Longest period downloaded with one request")
+    parser.add_argument('-z', '--gzip', dest='gzip', required=False,
+                        action='store_true', default=False,
+                        help="Compress downloaded ofx files")
+    parser.add_argument('--archive', dest='archive', required=False,
+                        help="Keep each new statement once in this content addressed "
+                             "archive and report unchanged ones")
+    parser.add_argument('-T', '--transactions', dest='transactions', required=False,
+                        action='store_true', default=False,
+                        help="Write transactions of downloaded statements as influxDB points")
+    parser.add_argument('-o', '--output-dir', dest='output_dir', required=False,
+                        default='/tmp',
+                        help="Directory of downloaded ofx files")
+    parser.add_argument('--store', dest='store', required=False,
+                        help="Add transactions and balances to this SQLite database")
+    parser.add_argument('-s', '--session-file', dest='session_file', required=False,
+                        help="Reuse the authenticated session saved in this file")
+    parser.add_argument('--session-ttl', dest='session_ttl', required=False,
+                        type=int, default=600,
+                        help="Saved session lifetime in seconds")
+    parser.add_argument('--page-cache-ttl', dest='page_cache_ttl', required=False,
+                        type=int, default=120,
+                        help="Seconds navigation pages are reused until the next POST, "
+                             "0 to disable")
+    parser.add_argument('--base-url', dest='base_url', required=False,
+                        help="Send requests of every host to this server "
+                             "(e.g. http://127.0.0.1:8080 for mockserver.py)")
+    parser.add_argument('-m', '--metrics', dest='metrics', required=False,
+                        action='store_true', default=False,
+                        help="Print request metrics in influxDB format")
+    parser.add_argument('-u', '--influxdb-url', dest='influxdb_url', required=False,
+                        help="Write influxDB points to this server "
+                             "(e.g. http://localhost:8086) instead of printing them")
+    parser.add_argument('--influxdb-db', dest='influxdb_db', required=False,
+                        default="desjardins")
+    parser.add_argument('--influxdb-spool', dest='influxdb_spool', required=False,
+                        help="Keep points which can not be written in this directory")
+    parser.add_argument('-D', '--daemon', dest='daemon', required=False,
+                        action='store_true', default=False,
+                        help="Keep the session and print changed balances "
+                             "in influxDB format every --interval seconds")
+    parser.add_argument('--interval', dest='interval', required=False,
+                        type=int, default=60,
+                        help="Seconds between balance polls in daemon mode, "
+                             "keep it below the AccesD idle timeout")
+    parser.add_argument('-E', '--exporter', dest='exporter', required=False,
+                        type=int,
+                        help="Serve balances on this port for Prometheus (/metrics) "
+                             "and influxDB (/influxdb), refreshed at most every --interval")
+    parser.add_argument('--exporter-bind', dest='exporter_bind', required=False,
+                        default='127.0.0.1')
+    return parser.parse_args(args)
+
+def is_summary(status, content):
+    """Check if a response is the account summary page
+    and not a redirection to the login page
+    """
+    return status == 200 and "panel-tiroir" in content
+
+def cache_key(host, path, data=None):
+    """Return the page cache key of a GET request"""
+    return (host, path, tuple(sorted((data or {}).items())))
+
+def detention_params():
+    """Get query parameters of the account summary page"""
+    params = {}
+    params["token"] = "1"
+    params["echange_string"] = None
+    params["statuts"] = None
+    return params
+
+class DesjardinsError(Exception):
+    """Error of the AccesD flow
+    exit_code is the exit status of desjardins.py
+    """
+    exit_code = 2
+
+    def __init__(self, message="", exit_code=None):
+        super(DesjardinsError, self).__init__(message)
+        if exit_code is not None:
+            self.exit_code = exit_code
+
+
+class SessionExpired(DesjardinsError):
+    """The AccesD session is not authenticated anymore"""
+
+
+class AuthenticationError(DesjardinsError):
+    """Credentials are refused or the website can not be trusted,
+    trying again will not help
+    """
+    exit_code = 5
+
+
+class DeadlineExceeded(DesjardinsError):
+    """The run or step deadline is over"""
+    exit_code = 7
+
+
+class CircuitOpen(DesjardinsError):
+    """Too many consecutive failures of an host, requests fail fast"""
+    exit_code = 8
+
+
+def get_parser():
+    """Get the html parser of the current thread"""
+    if not hasattr(_PARSERS, "parser"):
+        _PARSERS.parser = etree.HTMLParser()
+    return _PARSERS.parser
+
+def first(xpath, node):
+    """Return the first node matching a compiled xpath or None"""
+    nodes = xpath(node)
+    if nodes:
+        return nodes[0]
+    return None
+
+
+class Page(object):
+    """Downloaded page, parsed only when the tree is needed"""
+    def __init__(self, content, url=None, content_type="text/html", record=None, status=200):
+        self.content = content
+        self.url = url
+        self.status = status
+        self.is_html = "html" in content_type
+        self.parse_time = 0
+        # Request record updated with the parse time
+        self.record = record
+        self._tree = None
+
+    @property
+    def parsed(self):
+        """Return True if the tree was already built"""
+        return self._tree is not None
+
+    @property
+    def tree(self):
+        """Return the lxml tree of the page or None if it is not html"""
+        if self._tree is None and self.is_html and self.content:
+            start = time.time()
+            try:
+                root = etree.fromstring(self.content, get_parser())
+                if root is not None:
+                    self._tree = root.getroottree()
+            except etree.XMLSyntaxError:
+                # TODO better handling
+                pass
+            self.parse_time = time.time() - start
+            if self.record is not None:
+                self.record["parse_time"] = self.parse_time
+        return self._tree
+
+    def find(self, path):
+        """Find the first element matching path"""
+        return self.tree.find(path)
+
+    def findall(self, path):
+        """Find all elements matching path"""
+        return self.tree.findall(path)
+
 
 def get_hidden_inputs(html):
     """Get all inputs (with value) with type
     hidden in the current html page
     """
     data = {}
-    for h_input in html.findall("//input[@type='hidden']"):
+    if isinstance(html, Page):
+        html = html.tree
+    for h_input in XPATH_HIDDEN_INPUTS(html):
         data[h_input.get('name')] = h_input.get('value')
     return data
 
 def get_errors(html):
     """Try to find html error messages"""
+    if isinstance(html, Page):
+        if "erreurSystem" not in html.content:
+            return False
+        html = html.tree
     errors = []
-    for span in html.findall("//span[@id='erreurSystem']"):
+    for span in XPATH_ERRORS(html):
         errors.append(span.text.strip())
         print span.text.strip()
     if len(errors) > 0:
         return True
     return False
 
-def write_output(name, options, data, url):
-    """Write html output on log file"""
-    if options.log_html:
-        print(url)
-        with open("/tmp/" + name + ".html", "w") as html_file:
-            html_file.write(data)
+def save_session(file_name, cookies, ttl):
+    """Save cookies and expiry metadata in a file
+    only readable by the current user
+    """
+    now = time.time()
+    session = {"saved_at": now,
+               "expires_at": now + ttl,
+               "cookies": [{"name": cookie.name,
+                            "value": cookie.value,
+                            "domain": cookie.domain,
+                            "path": cookie.path,
+                            "secure": cookie.secure,
+                            "expires": cookie.expires}
+                           for cookie in cookies]}
+    tmp_file_name = file_name + ".tmp"
+    fd = os.open(tmp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "w") as session_file:
+        json.dump(session, session_file)
+    os.rename(tmp_file_name, file_name)
+
+def load_session(file_name, cookies):
+    """Load saved cookies in the cookie jar
+    Return False if there is no usable saved session
+    """
+    try:
+        with open(file_name) as session_file:
+            session = json.load(session_file)
+    except (IOError, ValueError):
+        return False
+    if session.get("expires_at", 0) < time.time():
+        return False
+    for cookie in session["cookies"]:
+        cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"],
+                    path=cookie["path"], secure=cookie["secure"],
+                    expires=cookie["expires"])
+    return True
 
 ###################################################################################################
 
-def format_influxdb(accounts):
-    """Print accounts to influxdb format"""
+def parse_accounts(page):
+    """Return the account list of the account summary page"""
+    accounts = []
+    for panel in XPATH_PANELS(page.tree):
+        # Get panel_type
+        try:
+            title = first(XPATH_PANEL_TITLE, panel)
+            panel_type = [t.strip() for t in title.itertext() if t.strip() != ''][2]
+            panel_type = panel_type.replace(",", "")
+        except AttributeError:
+            continue
+        # Get accounts
+        for raw_account in XPATH_PANEL_ACCOUNTS(panel):
+            account = {}
+            try:
+                account["fullname"] = first(XPATH_ACCOUNT_NAME, raw_account).text.strip()
+            except AttributeError:
+                continue
+            account["category"] = panel_type
+            account["id"], account["type"] = account["fullname"].split(" ", 1)
+            account["caisse"] = first(XPATH_ACCOUNT_CAISSE, raw_account).text.strip()
+            try:
+                description = first(XPATH_ACCOUNT_DESCRIPTION, raw_account).text.strip()
+                description = description.replace(u"\u2212", " ")
+                description = description.replace(u"\xa0", " ")
+                account["description"] = description.strip()
+            except AttributeError:
+                pass
+            balance = first(XPATH_ACCOUNT_BALANCE, raw_account).text.strip()
+            balance = balance.replace(u"\xa0", "")
+            balance = balance.replace(u"$", "")
+            balance = balance.replace(u",", ".")
+            balance = balance.replace(u"\u2212", "-")
+            account["balance"] = float(balance)
+            if account["category"] == u'Cartes pr\xeats et marges de cr\xe9dit':
+                # negate the number
+                account["balance"] = 0 - account["balance"]
+            accounts.append(account)
+
+    return accounts
+
+def influxdb_lines(accounts, timestamp=None, profile=None):
+    """Return accounts in influxdb format
+    profile is added as a tag when accounts of several profiles are written
+    """
+    lines = []
     for account in accounts:
-        # tags
-        tags = ("fullname=%(fullname)s,category=%(category)s,type=%(type)s,"
-                "id=%(id)s,caisse=%(caisse)s,unit=$")
-        if "description" in account.keys():
-            tags = tags + ",description=%(description)s"
-        tags = tags % account
-        tags = tags.replace(" ", r"\ ")
-        # influxdb
-        line = "accounts," + tags + " solde=%(balance)0.2f" % account
-        print "{}".format(line.encode("utf-8"))
-    sys.exit(0)
+        tags = [(key, account.get(key))
+                for key in ("fullname", "category", "type", "id", "caisse")]
+        tags.append(("unit", "$"))
+        tags.append(("description", account.get("description")))
+        tags.append(("profile", profile))
+        lines.append(make_line("accounts", tags, [("solde", round(account["balance"], 2))],
+                               timestamp))
+    return lines
+
+def metrics_lines(history, events, profile=None):
+    """Return request metrics and re-authentication events in influxdb format"""
+    lines = []
+    for record in history:
+        tags = [(key, record.get(key)) for key in ("host", "step", "method", "path", "status")]
+        tags.append(("profile", profile))
+        timings = record.get("timings", {})
+        fields = [("%s_ms" % name, round(timings.get(name, 0) * 1000, 3))
+                  for name in ("dns", "connect", "tls")]
+        fields.append(("ttfb_ms", round(record.get("ttfb", 0) * 1000, 3)))
+        fields.append(("total_ms", round(record["elapsed"] * 1000, 3)))
+        fields.append(("parse_ms", round(record["parse_time"] * 1000, 3)))
+        fields.append(("bytes", record["bytes"]))
+        fields.append(("retries", record.get("retries", 0)))
+        fields.append(("redirect", 300 <= (record["status"] or 0) < 400))
+        lines.append(make_line("desjardins_request", tags, fields, record["start"]))
+    for event in events:
+        lines.append(make_line("desjardins_reauth",
+                               [("step", event["step"]), ("reason", event["reason"]),
+                                ("profile", profile)],
+                               [("count", 1)], event["time"]))
+    return lines
+
+
+class LockedCookieJar(requests.cookies.RequestsCookieJar):
+    """Cookie jar which can be shared between threads"""
+    def __iter__(self):
+        # cookielib only locks updates, take a snapshot while iterating
+        with self._cookies_lock:
+            cookies = list(super(LockedCookieJar, self).__iter__())
+        return iter(cookies)
+
+    def copy(self):
+        new_cj = LockedCookieJar()
+        new_cj.update(self)
+        return new_cj
+
+
+class TimedConnectionMixin(object):
+    """Record DNS, TCP connect and TLS handshake times of a connection
+    DNS is resolved once before connecting to time it on its own
+    """
+    def _new_conn(self):
+        self.timings = {}
+        start = time.time()
+        try:
+            socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        except socket.error:
+            # Let the connection report the error
+            pass
+        self.timings["dns"] = time.time() - start
+        start = time.time()
+        conn = super(TimedConnectionMixin, self)._new_conn()
+        self.timings["connect"] = time.time() - start
+        return conn
+
+    def connect(self):
+        start = time.time()
+        super(TimedConnectionMixin, self).connect()
+        self.timings["tls"] = max(0, time.time() - start - self.timings["dns"]
+                                  - self.timings["connect"])
+
+
+class TimedHTTPConnection(TimedConnectionMixin, urllib3.connection.HTTPConnection):
+    """HTTP connection with timings"""
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, urllib3.connection.HTTPSConnection):
+    """HTTPS connection with timings"""
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTP adapter which counts new connections (handshakes)
+    and reused keep-alive connections
+    """
+    def __init__(self, *args, **kwargs):
+        self.handshakes = 0
+        self.reused = 0
+        super(CountingAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        pool = self.get_connection(request.url, kwargs.get('proxies'))
+        if isinstance(pool, urllib3.HTTPSConnectionPool):
+            pool.ConnectionCls = TimedHTTPSConnection
+        else:
+            pool.ConnectionCls = TimedHTTPConnection
+        connections = pool.num_connections
+        res = super(CountingAdapter, self).send(request, **kwargs)
+        if pool.num_connections > connections:
+            self.handshakes += pool.num_connections - connections
+        else:
+            self.reused += 1
+        # Timings of a new connection, empty for a reused one
+        conn = getattr(res.raw, "_connection", None)
+        res.timings = getattr(conn, "timings", {})
+        if conn is not None:
+            conn.timings = {}
+        return res
+
+
+class HostLimiter(object):
+    """Limit the request rate of each host and the requests in flight,
+    can be shared by several connections
+    """
+    def __init__(self, rate=None, max_requests=None):
+        self.interval = 1. / rate if rate else 0
+        self.semaphore = None
+        if max_requests:
+            self.semaphore = threading.BoundedSemaphore(max_requests)
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        """Sleep until a request can be sent to host"""
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next.get(host, 0))
+            self._next[host] = start + self.interval
+        time.sleep(start - now)
+
+    @contextmanager
+    def limit(self, host):
+        """Hold a request slot while a request is sent to host"""
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        try:
+            self.wait(host)
+            yield
+        finally:
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+
+class CircuitBreaker(object):
+    """Open after threshold consecutive failures of an host,
+    let one request through every cooldown seconds while open
+    """
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a request can be sent"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.cooldown:
+                # Half open, the next requests wait for this one
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        """Close the breaker"""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        """Count a failure, open the breaker at the threshold"""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+
+class SessionPool(object):
+    """Keep-alive HTTP sessions, one per host,
+    all sharing the same cookie jar
+    """
+    def __init__(self, cookies, headers, pool_size=2, timeout=(10, 30), base_url=None,
+                 limiter=None, recorder=None, replayer=None, retries=2, retry_budget=10,
+                 backoff=0.5):
+        self.cookies = cookies
+        self.headers = headers
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.base_url = base_url
+        self.limiter = limiter
+        # Traffic archive, see recorder.py
+        self.recorder = recorder
+        self.replayer = replayer
+        # GET retries, retry_budget is shared by all requests of the run
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self.backoff = backoff
+        self.breakers = {}
+        # Run deadline, see start_deadline
+        self.deadline = None
+        self.deadline_seconds = None
+        self.sessions = {}
+        # One record by request
+        self.history = []
+        self._lock = threading.Lock()
+        # Parsed pages by (host, path, params), see cache_get
+        self.page_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Current flow step of each thread
+        self._local = threading.local()
+
+    def start_deadline(self, seconds):
+        """Start the run deadline, no deadline if seconds is 0 or None"""
+        self.deadline_seconds = seconds or None
+        self.deadline = time.time() + seconds if seconds else None
+
+    def remaining(self):
+        """Return seconds left before the step or run deadline of this thread,
+        None without deadline
+        """
+        deadline = getattr(self._local, "deadline", None) or self.deadline
+        if deadline is None:
+            return None
+        return deadline - time.time()
+
+    def set_step(self, step):
+        """Set the flow step of the next requests of this thread
+        The step can use its share of the run deadline
+        """
+        self._local.step = step
+        self._local.deadline = None
+        if self.deadline is not None:
+            self._local.deadline = min(self.deadline, time.time() +
+                                       STEP_SHARES.get(step, 1) * self.deadline_seconds)
+
+    def get_step(self):
+        """Get the flow step of this thread"""
+        return getattr(self._local, "step", None)
+
+    def url(self, host, path):
+        """Build the url of path on host"""
+        if self.base_url is not None:
+            return self.base_url.rstrip("/") + path
+        return SCHEME + host + path
+
+    def session(self, host):
+        """Return the session of an host, create it if needed"""
+        with self._lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = CountingAdapter(pool_connections=1,
+                                          pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.cookies = self.cookies
+                session.headers.update(self.headers)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def breaker(self, host):
+        """Return the circuit breaker of an host"""
+        with self._lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker()
+            return self.breakers[host]
+
+    def _retry(self, method, attempt):
+        """Wait before retrying a request
+        Return False if it should not be retried
+        """
+        if method.upper() != "GET" or attempt >= self.retries:
+            return False
+        with self._lock:
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+        # Full jitter exponential backoff
+        delay = random.uniform(0, self.backoff * 2 ** attempt)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            return False
+        time.sleep(delay)
+        return True
+
+    def _send(self, method, host, path, kwargs):
+        """Send a request once, timeouts are cut to the remaining time"""
+        remaining = self.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded("Deadline exceeded before {} {}{}".format(
+                    method.upper(), host, path))
+            timeout = kwargs["timeout"]
+            if not isinstance(timeout, tuple):
+                timeout = (timeout, timeout)
+            kwargs = dict(kwargs, timeout=tuple(min(value, remaining) for value in timeout))
+        try:
+            if self.limiter is None:
+                return self.session(host).request(method.upper(), self.url(host, path),
+                                                  **kwargs)
+            with self.limiter.limit(host):
+                return self.session(host).request(method.upper(), self.url(host, path),
+                                                  **kwargs)
+        except requests.Timeout:
+            remaining = self.remaining()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded("Deadline exceeded during {} {}{}".format(
+                    method.upper(), host, path))
+            raise
+
+    def cache_get(self, key):
+        """Return the cached page of key or None if missing or expired"""
+        with self._lock:
+            expires, page = self.page_cache.get(key, (0, None))
+            if expires < time.time():
+                self.cache_misses += 1
+                return None
+            self.cache_hits += 1
+            return page
+
+    def cache_pop(self, key):
+        """Return the cached page of key only once, or None if missing or expired"""
+        with self._lock:
+            expires, page = self.page_cache.pop(key, (0, None))
+            if expires < time.time():
+                return None
+            self.cache_hits += 1
+            return page
+
+    def cache_put(self, key, page, ttl):
+        """Cache a page for ttl seconds"""
+        with self._lock:
+            self.page_cache[key] = (time.time() + ttl, page)
+
+    def invalidate(self, host=None):
+        """Drop cached pages of host, or all cached pages"""
+        with self._lock:
+            for key in list(self.page_cache):
+                if host is None or key[0] == host:
+                    del self.page_cache[key]
+
+    def request(self, method, host, path, **kwargs):
+        """Send a request to host using its kept-alive session
+        Cached pages of host are dropped when the request may change its state
+        GETs are retried on connection errors, timeouts and server errors,
+        requests to an host failing again and again raise CircuitOpen
+        The request record is available as the record attribute of the response
+        With a replayer, recorded responses are returned instead
+        """
+        if method.upper() != "GET":
+            self.invalidate(host)
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('verify', True)
+        start = time.time()
+        record = {"method": method.upper(), "host": host, "path": path.split("?", 1)[0],
+                  "step": self.get_step(), "start": start, "retries": 0,
+                  "status": None, "bytes": 0, "elapsed": 0, "parse_time": 0}
+        self.history.append(record)
+        if self.replayer is not None:
+            res = self.replayer.response(method, host, path, self.url(host, path))
+        else:
+            breaker = self.breaker(host)
+            while True:
+                if not breaker.allow():
+                    raise CircuitOpen("{} is failing, {} {} not sent".format(
+                        host, method.upper(), path))
+                try:
+                    res = self._send(method, host, path, kwargs)
+                except (requests.ConnectionError, requests.Timeout):
+                    breaker.failure()
+                    if not self._retry(method, record["retries"]):
+                        raise
+                else:
+                    if res.status_code < 500:
+                        breaker.success()
+                        break
+                    breaker.failure()
+                    if not self._retry(method, record["retries"]):
+                        break
+                    res.close()
+                record["retries"] += 1
+        record["status"] = res.status_code
+        record["ttfb"] = res.elapsed.total_seconds()
+        record["timings"] = getattr(res, "timings", {})
+        if not kwargs.get("stream"):
+            record["bytes"] = len(res.content)
+        if self.recorder is not None and self.replayer is None:
+            recording = (method, host, path, kwargs.get("params"), kwargs.get("data"),
+                         res, record["step"])
+            if kwargs.get("stream"):
+                # Recorded by iter_content once read
+                res.recording = recording
+            else:
+                self.recorder.record(*recording)
+        record["elapsed"] = time.time() - start
+        res.record = record
+        return res
+
+    def iter_content(self, res, chunk_size):
+        """Yield chunks of a streamed response
+        A recorded response is copied to a body file by chunks
+        and recorded once it is completely read
+        """
+        recording = getattr(res, "recording", None)
+        if recording is None:
+            for chunk in res.iter_content(chunk_size=chunk_size):
+                yield chunk
+            return
+        body_file = self.recorder.body_file()
+        complete = False
+        try:
+            for chunk in res.iter_content(chunk_size=chunk_size):
+                body_file.write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            body_file.close()
+            if complete:
+                self.recorder.record(*recording, body_file=body_file.name)
+            else:
+                os.remove(body_file.name)
+
+    def close(self):
+        """Close kept-alive connections and the traffic archive"""
+        for session in self.sessions.values():
+            session.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def stats(self):
+        """Return handshakes and reused connections counters by host"""
+        stats = {}
+        for host, session in self.sessions.items():
+            adapter = session.get_adapter(self.url(host, "/"))
+            stats[host] = {"handshakes": adapter.handshakes,
+                           "reused": adapter.reused}
+        return stats
 
 
 class DesjardinsConnection(object):
-    """Class to connect and get data from accesd"""
-    def __init__(self, options):
+    """Class to connect and get data from accesd
+    credentials default to settings.py, see get_credentials
+    """
+    def __init__(self, options, credentials=None, limiter=None, name="desjardins"):
         self.options = options
+        for directory in (options.output_dir, options.sync_dir):
+            if directory is not None and not os.path.isdir(directory):
+                os.makedirs(directory)
+        if credentials is None:
+            if settings is None:
+                raise ValueError('No credentials and no settings.py')
+            credentials = get_credentials(settings)
+        self.credentials = credentials
         # Cookies
-        self.cookies = {}
+        self.cookies = LockedCookieJar()
         # Headers
         self.headers = {}
         self.headers['User-Agent'] = ('Mozilla/5.0 (X11; Linux x86_64; rv:10.0.7) '
                                       'Gecko/20100101 Firefox/10.0.7 Iceweasel/10.0.7')
-        # Parser
-        self.parser = etree.HTMLParser()
+        # Traffic archive
+        recorder = None
+        record_dir = options.record or (RECORD_DIR if options.log_html else None)
+        if record_dir is not None and options.replay is None:
+            recorder = Recorder(record_dir, secrets=make_secrets(credentials))
+            atexit.register(recorder.close)
+        replayer = None
+        if options.replay is not None:
+            replayer = Replayer(options.replay, secrets=make_secrets(credentials))
+        # HTTP sessions
+        self.sessions = SessionPool(self.cookies, self.headers,
+                                    pool_size=max(options.pool_size, options.workers),
+                                    timeout=(options.connect_timeout, options.read_timeout),
+                                    base_url=options.base_url, limiter=limiter,
+                                    recorder=recorder, replayer=replayer,
+                                    retries=options.retries,
+                                    retry_budget=options.retry_budget)
+        self.sessions.start_deadline(options.deadline)
         # Accounts
         self.accounts = {'VISA': ('', 'VISA')}
+        # VISA navigation links found in the current session
+        self._visa_links = {}
+        # Sync state
+        self._sync_lock = threading.Lock()
 
         # Set logs
-        self.logger = logging.Logger("desjardins")
+        self.logger = logging.Logger(name)
         numeric_level = getattr(logging, options.log_level.upper(), None)
         if not isinstance(numeric_level, int):
             raise ValueError('Invalid log level: %s' % options.log_level)
@@ -127,8 +961,70 @@ class DesjardinsConnection(object):
         self.logger.addHandler(ch)
         #
         self._authenticate_retry = False
+        # Re-authentication events
+        self.events = []
+        # InfluxDB points
+        self.writer = None
+        if options.influxdb_url is not None:
+            self.writer = InfluxDBWriter(options.influxdb_url, options.influxdb_db,
+                                         spool_dir=options.influxdb_spool,
+                                         logger=self.logger)
+        # Local transaction store
+        self.store = None
+        if options.store is not None:
+            self.store = TransactionStore(options.store)
+        # Statement archive, accounts whose statement did not change
+        self.archive = None
+        if options.archive is not None:
+            self.archive = Archive(options.archive)
+        self.unchanged = set()
+        # Statements of the transactions added by sync_ofx, by account
+        self.sync_deltas = {}
 
-    def _request(self, host, path, method='get', data=None):
+    def emit(self, lines):
+        """Write influxDB points to the server or print them"""
+        if self.writer is not None:
+            self.writer.write(lines)
+            return
+        for line in lines:
+            print "{}".format(line.encode("utf-8"))
+
+    def emit_metrics(self):
+        """Write request metrics if --metrics is set and send buffered points"""
+        if self.options.metrics:
+            self.emit(metrics_lines(self.sessions.history, self.events))
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """Send the remaining points and close the InfluxDB writer and the store
+        Return False if points were lost or rejected
+        """
+        delivered = True
+        if self.writer is not None:
+            delivered = self.writer.close()
+            if not delivered:
+                print "InfluxDB points lost: {}, batches rejected: {}".format(
+                    self.writer.lost, self.writer.rejected)
+        if self.store is not None:
+            self.store.close()
+        return delivered
+
+    def add_event(self, reason):
+        """Record a re-authentication event"""
+        self.events.append({"time": time.time(), "reason": reason,
+                            "step": self.sessions.get_step() or "login"})
+
+    def log_stats(self):
+        """Log connections counters"""
+        for host, stats in self.sessions.stats().items():
+            self.logger.info("%s: %d handshake(s), %d reused connection(s)",
+                             host, stats["handshakes"], stats["reused"])
+        self.logger.debug("Page cache: %d hit(s), %d miss(es)",
+                          self.sessions.cache_hits, self.sessions.cache_misses)
+
+    def _fetch(self, host, path, method='get', data=None):
+        """Send a request and return the raw response"""
         # Set default
         if data is None:
             data = {}
@@ -140,44 +1036,108 @@ class DesjardinsConnection(object):
             data = data
             params = {}
         # build URL
-        url = SCHEME + host + path
+        url = self.sessions.url(host, path)
         self.logger.info("Getting: %s", url)
-        raw_res = getattr(requests, method.lower())(url, data=data, params=params,
-                                                    cookies=self.cookies, headers=self.headers,
-                                                    verify=True, allow_redirects=False)
-        # Write log
-        write_output("log", self.options, raw_res.content, url)
+        raw_res = self.sessions.request(method, host, path, data=data, params=params,
+                                        allow_redirects=False)
 
         # TODO better check output and status_code
 #        if raw_res.content == "":
 #            print "Web site error. Maintenance ?"
 #            sys.exit(10)
+        return raw_res
 
-        # Read html
-        res = StringIO(raw_res.content)
-        tree = None
-        try:
-            tree = etree.parse(res, self.parser)
-        except etree.XMLSyntaxError:
-            # TODO better handling
-            pass
+    def _request(self, host, path, method='get', data=None, cache=False):
+        """Send a request and return the parsed html
+        With cache, a GET page is reused for --page-cache-ttl seconds
+        or until the next POST to the same host
+        """
+        cache = cache and method == "get" and self.options.page_cache_ttl > 0
+        if cache:
+            key = cache_key(host, path, data)
+            page = self.sessions.cache_get(key)
+            if page is not None:
+                self.logger.debug("Cached: %s", self.sessions.url(host, path))
+                return page
+        raw_res = self._fetch(host, path, method, data)
+        url = raw_res.url
+
+        # Read html when needed
+        page = Page(raw_res.content, url, raw_res.headers.get("Content-Type", "text/html"),
+                    record=raw_res.record, status=raw_res.status_code)
 
         # Try to found some error in html
-        if tree is not None:
-            errors = get_errors(tree)
+        if page.is_html:
+            errors = get_errors(page)
             if errors:
                 self.logger.fatal("Getting: %s", url)
-                sys.exit(2)
-
-        # Update cookies
-        self.cookies.update(raw_res.cookies)
+                raise DesjardinsError("Error page: {}".format(url), 2)
 
+        if cache:
+            self.sessions.cache_put(key, page, self.options.page_cache_ttl)
         # Return
-        return tree
+        return page
 
 
+    def _download(self, host, path, file_name, method='get', data=None):
+        """Stream a response to file_name, compressed if --gzip is set
+        The file is written in a temporary file which is renamed when complete,
+        error pages and redirections to the login page are never saved
+        Return the saved file name
+        """
+        if self.options.gzip:
+            file_name += ".gz"
+        start = time.time()
+        self.logger.info("Downloading: %s", self.sessions.url(host, path))
+        raw_res = self.sessions.request(method, host, path, data=data, stream=True)
+        tmp_file_name = None
+        try:
+            error = None
+            for res in raw_res.history:
+                if "/identifiantunique/" in res.headers.get("Location", ""):
+                    error = SessionExpired("Redirected to login downloading " + path)
+            if error is None and not 200 <= raw_res.status_code < 300:
+                error = DesjardinsError("Error {} downloading {}".format(raw_res.status_code,
+                                                                         path))
+            chunks = self.sessions.iter_content(raw_res, 64 * 1024)
+            first_chunk = next(chunks, "")
+            if error is None and "erreurSystem" in first_chunk:
+                error = DesjardinsError("Error page downloading " + path)
+            if error is not None:
+                # Error pages are small, read them whole to record them
+                for _ in chunks:
+                    pass
+                raise error
+            fd, tmp_file_name = tempfile.mkstemp(dir=os.path.dirname(file_name),
+                                                 prefix=os.path.basename(file_name) + ".")
+            with os.fdopen(fd, "wb") as raw_file:
+                if self.options.gzip:
+                    out_file = gzip.GzipFile(fileobj=raw_file, mode="wb")
+                else:
+                    out_file = raw_file
+                for chunk in itertools.chain([first_chunk], chunks):
+                    remaining = self.sessions.remaining()
+                    if remaining is not None and remaining <= 0:
+                        raise DeadlineExceeded("Deadline exceeded downloading " + file_name)
+                    out_file.write(chunk)
+                    raw_res.record["bytes"] += len(chunk)
+                if out_file is not raw_file:
+                    out_file.close()
+            # mkstemp files are private
+            os.chmod(tmp_file_name, FILE_MODE)
+            os.rename(tmp_file_name, file_name)
+            raw_res.record["elapsed"] = time.time() - start
+        except:
+            if tmp_file_name is not None:
+                os.remove(tmp_file_name)
+            raise
+        finally:
+            raw_res.close()
+        return file_name
+
     def _authenticate(self, defi_enable=True):
         """Log in accesd website"""
+        self.sessions.set_step("login")
         ###########################################
         tree = self._request(ACCWEB_HOST,
                              "/identifiantunique/identification",
@@ -185,7 +1145,7 @@ class DesjardinsConnection(object):
 
         #########################################
         data = get_hidden_inputs(tree)
-        data["codeUtilisateur"] = number
+        data["codeUtilisateur"] = self.credentials["number"]
         data["description"] = None
         data["infoPosteClient"] = "version=3.4.1.0_1&pm_fpua=mozilla/5.0 (x11; linux x86_64) applewebkit/537.36 (khtml, like gecko) chrome/49.0.2623.108 safari/537.36|5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/49.0.2623.108 Safari/537.36|Linux x86_64&pm_fpsc=24|1920|1200|1175&pm_fpsw=&pm_fptz=-5&pm_fpln=lang=en-US|syslang=|userlang=&pm_fpjv=0&pm_fpco=1&pm_fpasw=mhjfbmdgcfjbbpaeojofohoefgiehjai|libpepflashplayer|internal-pdf-viewer&pm_fpan=Netscape&pm_fpacn=Mozilla&pm_fpol=true&pm_fposp=&pm_fpup=&pm_fpsaw=1920&pm_fpspd=24&pm_fpsbd=&pm_fpsdx=&pm_fpsdy=&pm_fpslx=&pm_fpsly=&pm_fpsfse=&pm_fpsui=&pm_os=Linux&pm_brmjv=49&pm_br=Chrome&pm_inpt=&pm_expt="
         tree = self._request(ACCWEB_HOST,
@@ -208,12 +1168,11 @@ class DesjardinsConnection(object):
                 raw_questions = [x.text.strip() for x in tree.findall("//label[@for='valeurReponse']/b")
                                  if x.text is not None]
                 for question in raw_questions:
-                    if question in questions:
-                        answer = questions[question]
+                    if question in self.credentials["questions"]:
+                        answer = self.credentials["questions"][question]
                         break
                 if answer is None:
-                    print "No answer found for question"
-                    sys.exit(3)
+                    raise AuthenticationError("No answer found for question", 3)
 
                 ###########################################################################################
                 data = get_hidden_inputs(tree)
@@ -239,48 +1198,82 @@ class DesjardinsConnection(object):
         if tree.find("//form//div/img") is None:
             # We don't need defi, so we need to retry without defi
             if self._authenticate_retry:
-                print "{}".format("Error during Authentication")
-                sys.exit(5)
+                raise AuthenticationError("Error during Authentication")
             else:
-                self.cookies = {}
+                self.cookies.clear()
+                self.add_event("defi_retry")
                 self._authenticate_retry = True
                 return self._authenticate(False)
 
         try:
-            secure_img_url = SCHEME + ACCWEB_HOST + tree.find("//form//div/img").get("src")
-            raw_res = requests.get(secure_img_url, cookies=self.cookies,
-                                   headers=self.headers, verify=True)
+            secure_img_path = tree.find("//form//div/img").get("src")
+            raw_res = self.sessions.request("get", ACCWEB_HOST, secure_img_path)
         except requests.ConnectionError:
-            print "{}".format("Error downloading image")
-            sys.exit(4)
+            raise DesjardinsError("Error downloading image", 4)
         if raw_res.status_code == 404:
-            print "{}".format("Error downloading image")
-            sys.exit(6)
+            raise DesjardinsError("Error downloading image", 6)
         # Check secure phrase
         true_desjardins = False
         try:
-            if tree.find("//form//div/strong").text.strip() == secure_phrase:
+            if tree.find("//form//div/strong").text.strip() == self.credentials["secure_phrase"]:
                 true_desjardins = True
         except AttributeError:
             pass
         if not true_desjardins:
-            print "{}".format("This is not desjardins")
-            sys.exit(5)
+            raise AuthenticationError("This is not desjardins")
 
         ###########################################################################################
         data = get_hidden_inputs(tree)
-        data["codeUtilisateur"] = number
-        data["motDePasse"] = password
+        data["codeUtilisateur"] = self.credentials["number"]
+        data["motDePasse"] = self.credentials["password"]
         tree = self._request(ACCWEB_HOST,
                              "/identifiantunique/authentification/authentificationProcess",
                              method="post",
                              data=data)
         return tree
 
-    def connect(self):
-        """Connect to accesd summary page"""
+    def session_valid(self):
+        """Check if the current session is still authenticated
+        by probing the account summary page
+        """
+        self.sessions.set_step("session_probe")
+        data = detention_params()
+        raw_res = self._fetch(ACCESD_HOST, DETENTION_PATH, method="get", data=data)
+        if not is_summary(raw_res.status_code, raw_res.content):
+            return False
+        # The next get_accounts uses the probed summary instead of fetching it again
+        if self.options.page_cache_ttl > 0:
+            page = Page(raw_res.content, raw_res.url,
+                        raw_res.headers.get("Content-Type", "text/html"),
+                        record=raw_res.record, status=raw_res.status_code)
+            self.sessions.cache_put(cache_key(ACCESD_HOST, DETENTION_PATH, data), page,
+                                    self.options.page_cache_ttl)
+        return True
+
+    def connect(self, reuse_session=True):
+        """Connect to accesd summary page
+        The saved session is not reused when reuse_session is False,
+        e.g. once it is known to be expired
+        """
+        self._authenticate_retry = False
+        # Pages and links of a previous session can not be reused
+        self.sessions.invalidate()
+        self._visa_links.clear()
+        session_file = self.options.session_file
+        if session_file is not None and reuse_session:
+            if load_session(session_file, self.cookies):
+                if self.session_valid():
+                    self.logger.info("Reusing saved session from %s", session_file)
+                    save_session(session_file, self.cookies, self.options.session_ttl)
+                    return
+                self.logger.info("Saved session expired")
+                self.add_event("session_expired")
+                self.cookies.clear()
+
         tree = self._authenticate()
 
+        self.sessions.set_step("sso")
+
         ###########################################################################################
         tree = self._request(ACCWEB_HOST,
                              "/identifiantunique/sso/redirect",
@@ -300,73 +1293,117 @@ class DesjardinsConnection(object):
                              method="post",
                              data=data)
 
+        if session_file is not None:
+            save_session(session_file, self.cookies, self.options.session_ttl)
+
     def get_accounts(self):
-        """Return the account list"""
-        params = {}
-        params["token"] = "1"
-        params["echange_string"] = None
-        params["statuts"] = None
-        tree = self._request(ACCESD_HOST,
-                             "/sommaire-perso/sommaire/detention",
-                             method="get",
-                             data=params)
+        """Return the account list
+        The summary of a session probe is used once, later calls fetch it again
+        """
+        self.sessions.set_step("accounts")
+        data = detention_params()
+        tree = self.sessions.cache_pop(cache_key(ACCESD_HOST, DETENTION_PATH, data))
+        if tree is None:
+            tree = self._request(ACCESD_HOST,
+                                 DETENTION_PATH,
+                                 method="get",
+                                 data=data)
+        if not is_summary(tree.status, tree.content):
+            raise SessionExpired()
 
-        ###########################################################################################
-        # Monitoring
-        accounts = []
-        for panel in tree.findall("//div[@class='panel panel-tiroir']"):
-            # Get panel_type
+        return parse_accounts(tree)
+
+    def refresh_accounts(self):
+        """Return the account list in a new run with its own deadline and retry budget
+        Authenticate again once if the session expired
+        """
+        self.sessions.start_deadline(self.options.deadline)
+        self.sessions.retry_budget = self.options.retry_budget
+        try:
+            return self.get_accounts()
+        except SessionExpired:
+            self.logger.info("Session expired, authenticating again")
+            self.add_event("session_expired")
+            self.cookies.clear()
+            # The saved session is the expired one
+            self.connect(reuse_session=False)
+            return self.get_accounts()
+
+    def serve_balances(self):
+        """Serve balances to scrapers until interrupted
+        Raise the fatal error which stopped the refreshes
+        """
+        def fetch():
+            """Refresh balances, request records are not kept"""
             try:
-                title = panel.find("div/h2/a")
-                panel_type = [t.strip() for t in title.itertext() if t.strip() != ''][2]
-                panel_type = panel_type.replace(",", "")
-            except AttributeError:
-                continue
-            # Get accounts
-            for raw_account in panel.findall("div//div[@class='section tiroir']"):
-                account = {}
-                try:
-                    account["fullname"] = raw_account.find(".//h3").text.strip()
-                except AttributeError:
-                    continue
-                account["category"] = panel_type
-                account["id"], account["type"] = account["fullname"].split(" ", 1)
-                account["caisse"] = raw_account.find(".//p/span[@class='desc-ligne2']").text.strip()
-                try:
-                    description = raw_account.find(".//p/span[@class='desc-ligne1']").text.strip()
-                    description = description.replace(u"\u2212", " ")
-                    description = description.replace(u"\xa0", " ")
-                    account["description"] = description.strip()
-                except AttributeError:
-                    pass
-                balance = raw_account.find(".//div/span[@class='montant']").text.strip()
-                balance = balance.replace(u"\xa0", "")
-                balance = balance.replace(u"$", "")
-                balance = balance.replace(u",", ".")
-                balance = balance.replace(u"\u2212", "-")
-                account["balance"] = float(balance)
-                if account["category"] == u'Cartes pr\xeats et marges de cr\xe9dit':
-                    # negate the number
-                    account["balance"] = 0 - account["balance"]
-                accounts.append(account)
-
-        return accounts
+                return self.refresh_accounts()
+            finally:
+                del self.sessions.history[:]
+                del self.events[:]
+        cache = BalanceCache(fetch, influxdb_lines, self.options.interval,
+                             fatal=(AuthenticationError,), logger=self.logger)
+        server = ExporterServer((self.options.exporter_bind, self.options.exporter), cache)
+        cache.start()
+        self.logger.info("Serving balances on %s:%d", *server.server_address)
+        server_thread = threading.Thread(target=server.serve_forever, name="exporter")
+        server_thread.daemon = True
+        server_thread.start()
+        try:
+            # Short waits keep KeyboardInterrupt working
+            while not cache.wait(1):
+                pass
+        finally:
+            server.shutdown()
+            server.server_close()
+        raise cache.error
+
+    def poll_balances(self):
+        """Print balances in influxDB format every --interval seconds
+        Only changed balances are printed, the session is kept and
+        authentication is done again only when it expires
+        """
+        balances = {}
+        while True:
+            start = time.time()
+            try:
+                accounts = self.refresh_accounts()
+            except AuthenticationError:
+                raise
+            except SessionExpired:
+                self.logger.error("No account summary after authentication")
+                accounts = []
+            except (requests.RequestException, DesjardinsError) as exp:
+                self.logger.error("Error getting accounts: %s", exp)
+                accounts = []
+            changed = [account for account in accounts
+                       if balances.get(account["fullname"]) != account["balance"]]
+            for account in changed:
+                balances[account["fullname"]] = account["balance"]
+            self.emit(influxdb_lines(changed, start))
+            if self.store is not None and changed:
+                self.store.add_balances(changed, start)
+            self.emit_metrics()
+            sys.stdout.flush()
+            del self.sessions.history[:]
+            del self.events[:]
+            time.sleep(max(0, self.options.interval - (time.time() - start)))
 
     def list_ofx_account(self):
         """Return the account list which can be
         downloaded as ofx file
         """
+        self.sessions.set_step("ofx_list")
         # get all accounts
         path = "/coreleADReleve/ObtenirSelectionConciliationBancaire.do?msgId=debuter"
         tree = self._request(ACCESD_HOST,
                              path,
-                             method="get")
+                             method="get",
+                             cache=True)
 
-        html_inputs = tree.findall("//input[@type='checkbox']")
+        html_inputs = XPATH_OFX_ACCOUNTS(tree.tree)
         # Only list accounts
         for html_input in html_inputs:
-            raw_account = [x for x in html_input.getparent().getparent().
-                           find(".//td[@class='c']").itertext()]
+            raw_account = [x for x in first(XPATH_OFX_ACCOUNT_NAME, html_input).itertext()]
             file_name = raw_account[2]
             account_name = " ".join(raw_account)
             account_name = account_name.strip()
@@ -379,19 +1416,22 @@ class DesjardinsConnection(object):
 
         return tree
 
-    def get_ofx_account(self, start_date=None, end_date=None):
-        """Download ofx file from an account"""
+    def get_ofx_account(self, account, start_date=None, end_date=None):
+        """Download ofx file from an account
+        Return the saved file name
+        """
         # get time
         now = datetime.datetime.now()
-        end_date = now - datetime.timedelta(days=1)
-        start_date = now - datetime.timedelta(days=31)
+        if end_date is None:
+            end_date = now - datetime.timedelta(days=1)
+        if start_date is None:
+            start_date = now - datetime.timedelta(days=31)
         # Find account name and id
-        file_name = self.options.account
-        account = self.accounts[self.options.account][1]
         tree = self.list_ofx_account()
+        self.sessions.set_step("ofx_account")
         # prepare data
         data = get_hidden_inputs(tree)
-        data[self.accounts[self.options.account][0]] = "on"
+        data[self.accounts[account][0]] = "on"
         data["chPeriode"] = "PI"
         data["chDateJourMin"] = "%02d" % start_date.day
         data["chDateMoisMin"] = "%02d" % start_date.month
@@ -409,23 +1449,14 @@ class DesjardinsConnection(object):
                       method="post",
                       data=data)
         # Get file
-        url13 = SCHEME + ACCESD_HOST + "/coreleADReleve/secondaire/ObtenirReleveOperations.do"
-        raw_res = requests.get(url13, cookies=self.cookies, headers=self.headers, verify=True)
-        self.cookies.update(raw_res.cookies)
-        # Save ofx
-        file_name = file_name + "_" + start_date.strftime("%Y%m%d") + \
-                    "-" + end_date.strftime("%Y%m%d")
-        with open("/tmp/" + file_name + ".ofx", "w") as ofx_file:
-            ofx_file.write(raw_res.content)
-        print u"{} saved in /tmp/{}.ofx".format(account, file_name)
-        sys.exit(0)
+        return self._download(ACCESD_HOST,
+                              "/coreleADReleve/secondaire/ObtenirReleveOperations.do",
+                              get_ofx_file_name(account, start_date, end_date,
+                                                self.options.output_dir))
 
-    def get_ofx_visa(self, start_date=None, end_date=None):
-        """Download ofx file from VISA account"""
-        # Get start and end date
-        start_date, end_date = get_date()
-
-        ##########################################################################################
+    def visa_logon(self):
+        """Log in VISA website from accesd"""
+        self.sessions.set_step("visa_logon")
         params = {"msgId": "debuter"}
         tree = self._request(ACCESD_HOST,
                              "/cooperADOperations/ObtenirInfoCartes.do",
@@ -439,42 +1470,63 @@ class DesjardinsConnection(object):
                       method="post",
                       data=data)
 
+    def _visa_link(self, href):
+        """Follow a navigation link of the VISA website"""
+        raw_params = href.split("?", 1)[-1].split("&")
+        params = {}
+        for param in raw_params:
+            params[param.split("=", 1)[0]] = param.split("=", 1)[-1]
+
+        return self._request(VISA_HOST,
+                             "/" + href,
+                             method="get",
+                             data=params,
+                             cache=True)
+
+    def _visa_form(self, logon=True):
+        """Go to the VISA download page
+        Return the download form data
+        """
+        if logon:
+            self.visa_logon()
+        self.sessions.set_step("visa")
+
+        # The download page link is kept for the session,
+        # browse from the account page only the first time
+        href = self._visa_links.get("download")
+        if href is not None:
+            form = get_hidden_inputs(self._visa_link(href))
+            if form:
+                return form
+            self._visa_links.clear()
+
         ##########################################################################################
         params = {"MSGID": "etatActuelCpte", "CLIENT": "HTML"}
         tree = self._request(VISA_HOST,
                              "/GCE/SAInfoCpte",
                              method="get",
-                             data=params)
+                             data=params,
+                             cache=True)
 
         ##########################################################################################
         raw_link = [x for x in tree.findall("""//td/a[@class="me"]""")
                     if x.text.strip() == u'Relev\xe9 de compte'][0]
-        raw_params = raw_link.get('href').split("?", 1)[-1].split("&")
-        params = {}
-        for param in raw_params:
-            params[param.split("=", 1)[0]] = param.split("=", 1)[-1]
-
-        tree = self._request(VISA_HOST,
-                             "/" + raw_link.get('href'),
-                             method="get",
-                             data=params)
+        tree = self._visa_link(raw_link.get('href'))
 
         ##########################################################################################
         raw_link = [x for x in tree.findall("""//a[@class="mse"]""")
                     if x.text.strip() == u'Conciliation / T\xe9l\xe9chargement'][0]
-        raw_params = raw_link.get('href').split("?", 1)[-1].split("&")
-        params = {}
-        for param in raw_params:
-            params[param.split("=", 1)[0]] = param.split("=", 1)[-1]
+        self._visa_links["download"] = raw_link.get('href')
+        tree = self._visa_link(raw_link.get('href'))
 
-        tree = self._request(VISA_HOST,
-                             "/" + raw_link.get('href'),
-                             method="get",
-                             data=params)
+        return get_hidden_inputs(tree)
 
-        ##########################################################################################
-        urlv6 = SCHEME + VISA_HOST + "/GCE/SAInfoCpte"
-        data = get_hidden_inputs(tree)
+    def _visa_statement(self, form, start_date, end_date):
+        """Download ofx file from VISA download form
+        Return the saved file name
+        """
+        self.sessions.set_step("visa")
+        data = dict(form)
         data['recharge'] = 'true'
         data['urlPDF'] = ''
         data['optionTelechg'] = 'HTML'
@@ -487,36 +1539,273 @@ class DesjardinsConnection(object):
         data['anneeFin'] = "%d" % end_date.year
         data['choixFormat'] = '2'
         data['formatTelechargement'] = 'OFX'
-        raw_res = requests.post(urlv6, data=data, cookies=self.cookies,
-                                headers=self.headers, verify=True)
-        self.cookies.update(raw_res.cookies)
-
-        file_name = "/tmp/VISA_" + start_date.strftime("%Y%m%d") + "_" + \
-                    end_date.strftime("%Y%m%d") + ".ofx"
-        with open(file_name, "w") as ofx_file:
-            ofx_file.write(raw_res.content)
-        print "VISA saved in {}".format(file_name)
-        sys.exit(0)
+        return self._download(VISA_HOST,
+                              "/GCE/SAInfoCpte",
+                              get_ofx_file_name("VISA", start_date, end_date,
+                                                self.options.output_dir),
+                              method="post",
+                              data=data)
 
-def main():
-    """Main function"""
-    conn = DesjardinsConnection(get_args())
+    def get_ofx_visa(self, start_date=None, end_date=None, logon=True):
+        """Download ofx file from VISA account
+        Return the saved file name
+        """
+        # Get start and end date
+        default_start_date, default_end_date = get_date()
+        if start_date is None:
+            start_date = default_start_date
+        if end_date is None:
+            end_date = default_end_date
+
+        form = self._visa_form(logon)
+        return self._visa_statement(form, start_date, end_date)
+
+    def get_ofx(self, account, start_date=None, end_date=None, visa_logon=True):
+        """Download ofx file from any account
+        Periods longer than --window-days are downloaded window by window
+        and stitched in one file
+        """
+        if start_date is None:
+            start_date = self.options.since
+        if start_date is not None and end_date is None:
+            end_date = datetime.datetime.now()
+            if account != "VISA":
+                end_date -= datetime.timedelta(days=1)
+        if start_date is None or \
+                (end_date - start_date).days < self.options.window_days:
+            if account == "VISA":
+                return self.get_ofx_visa(start_date, end_date, logon=visa_logon)
+            return self.get_ofx_account(account, start_date, end_date)
+
+        windows = get_windows(start_date, end_date, self.options.window_days)
+        self.logger.info("Downloading %s in %d windows", account, len(windows))
+        # Window files by position, so the ones downloaded before a failure are removed too
+        file_names = [None] * len(windows)
+        try:
+            if account == "VISA":
+                # Each download is a single stateless POST of the same form
+                form = self._visa_form(visa_logon)
+
+                def download_window(index):
+                    """Download one VISA window"""
+                    file_names[index] = self._visa_statement(form, *windows[index])
+
+                pool = ThreadPool(self.options.workers)
+                try:
+                    pool.map(download_window, range(len(windows)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                # The download depends on the previously posted selection
+                for index, window in enumerate(windows):
+                    file_names[index] = self.get_ofx_account(account, *window)
+
+            # Stitch windows, oldest first
+            file_name = get_ofx_file_name(account, start_date, end_date, self.options.output_dir)
+            if self.options.gzip:
+                file_name += ".gz"
+            ofx.merge_ofx_files(file_names, file_name)
+        finally:
+            for window_file_name in file_names:
+                if window_file_name is not None and os.path.exists(window_file_name):
+                    os.remove(window_file_name)
+        return file_name
+
+    def _sync_state_file(self):
+        """Return the sync state file name"""
+        return os.path.join(self.options.sync_dir, "state.json")
+
+    def _load_sync_state(self):
+        """Return high-water marks by account"""
+        try:
+            with open(self._sync_state_file()) as state_file:
+                return json.load(state_file)
+        except (IOError, ValueError):
+            return {}
+
+    def sync_ofx(self, account, visa_logon=True):
+        """Download transactions posted since the last sync of an account
+        and merge them in its ofx file
+        The added transactions are also saved in sync_deltas[account]
+        Return the merged file name
+        """
+        state = self._load_sync_state().get(account, {})
+        start_date = self.options.since
+        if state.get("date"):
+            start_date = datetime.datetime.strptime(state["date"], "%Y%m%d")
+            start_date -= datetime.timedelta(days=self.options.overlap)
+        downloaded_file = self.get_ofx(account, start_date=start_date, visa_logon=visa_logon)
+
+        file_name = os.path.join(self.options.sync_dir, account + ".ofx")
+        if self.options.gzip:
+            file_name += ".gz"
+        delta_file = os.path.join(self.options.output_dir, account + "_new.ofx")
+        if self.options.gzip:
+            delta_file += ".gz"
+        file_names = [downloaded_file]
+        if os.path.exists(file_name):
+            file_names.insert(0, file_name)
+        try:
+            added, (last_date, last_fitid) = ofx.merge_ofx_files(file_names, file_name,
+                                                                 delta_file)
+        finally:
+            os.remove(downloaded_file)
+        self.sync_deltas[account] = delta_file
+        self.logger.info("%s: %d new transaction(s)", account, added[-1])
+
+        # Save high-water mark
+        if last_date is not None:
+            with self._sync_lock:
+                states = self._load_sync_state()
+                states[account] = {"date": last_date.strftime("%Y%m%d"),
+                                   "fitid": last_fitid}
+                with open(self._sync_state_file() + ".tmp", "w") as state_file:
+                    json.dump(states, state_file, indent=2, sort_keys=True)
+                os.rename(self._sync_state_file() + ".tmp", self._sync_state_file())
+        return file_name
+
+    def _download_flow(self, accounts, visa_logon=True):
+        """Download ofx files from accounts one after the other"""
+        if self.options.sync_dir is not None:
+            get_ofx = self.sync_ofx
+        else:
+            get_ofx = self.get_ofx
+        summary = []
+        for account in accounts:
+            try:
+                file_name = get_ofx(account, visa_logon=visa_logon)
+                if self.archive is not None:
+                    downloaded_file = file_name
+                    file_name, changed = self.archive.add(account, downloaded_file)
+                    # The archive keeps it, the sync file is merged again next run
+                    if self.options.sync_dir is None:
+                        os.remove(downloaded_file)
+                    if not changed:
+                        self.logger.info("Statement of %s unchanged", account)
+                        self.unchanged.add(account)
+                summary.append((account, file_name, None))
+            except Exception as exp:
+                self.logger.error("Error downloading %s: %s", account, exp)
+                summary.append((account, None, exp))
+        return summary
+
+    def download_ofx(self, accounts):
+        """Download ofx files from several accounts in the same session
+        Return a summary as a list of (account, file name, error)
+        """
+        bank_accounts = [account for account in accounts if account != "VISA"]
+        visa_accounts = [account for account in accounts if account == "VISA"]
+        if self.options.workers < 2 or not bank_accounts or not visa_accounts:
+            summary = self._download_flow(accounts)
+            self.log_stats()
+            return summary
+
+        # Once logged in VISA website, the accesd flow and the VISA flow
+        # talk to different hosts, so they can run at the same time.
+        # The accesd flow stays sequential: the file download depends
+        # on the previously posted account selection.
+        try:
+            self.visa_logon()
+        except Exception as exp:
+            # Bank accounts are still downloaded
+            self.logger.error("Error logging in VISA website: %s", exp)
+            summary = (self._download_flow(bank_accounts) +
+                       [(account, None, exp) for account in visa_accounts])
+            self.log_stats()
+            return sorted(summary, key=lambda result: accounts.index(result[0]))
+        pool = ThreadPool(min(self.options.workers, 2))
+        try:
+            results = [pool.apply_async(self._download_flow, (bank_accounts,)),
+                       pool.apply_async(self._download_flow, (visa_accounts, False))]
+            summary = results[0].get() + results[1].get()
+        finally:
+            pool.close()
+            pool.join()
+        self.log_stats()
+        return sorted(summary, key=lambda result: accounts.index(result[0]))
+
+def run(conn):
+    """Run the command line flow"""
     conn.connect()
 
+    if conn.options.exporter is not None:
+        try:
+            conn.serve_balances()
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    if conn.options.daemon:
+        try:
+            conn.poll_balances()
+        except KeyboardInterrupt:
+            sys.exit(0)
+
     if conn.options.influxdb:
         accounts = conn.get_accounts()
-        format_influxdb(accounts)
+        conn.log_stats()
+        conn.emit(influxdb_lines(accounts, time.time()))
+        if conn.store is not None:
+            conn.store.add_balances(accounts, time.time())
+        conn.emit_metrics()
         sys.exit(0)
 
     conn.list_ofx_account()
-    if conn.options.account not in conn.accounts:
+    if conn.options.all_accounts:
+        accounts = sorted(conn.accounts.keys())
+    else:
+        accounts = conn.options.account
+    if not accounts or [a for a in accounts if a not in conn.accounts]:
         print "Account not found, use -l option"
         sys.exit(0)
 
-    if conn.options.account == "VISA":
-        conn.get_ofx_visa()
-    else:
-        conn.get_ofx_account()
+    summary = conn.download_ofx(accounts)
+    for account, file_name, error in summary:
+        if error is not None:
+            print u"{} failed: {}".format(conn.accounts[account][1], error)
+        elif account in conn.unchanged:
+            print u"{} unchanged, latest in {}".format(conn.accounts[account][1], file_name)
+        else:
+            print u"{} saved in {}".format(conn.accounts[account][1], file_name)
+    # Unchanged statements were handled by a previous run,
+    # only the added transactions of synced statements are new
+    new_files = [conn.sync_deltas.get(account, file_name)
+                 for account, file_name, error in summary
+                 if error is None and account not in conn.unchanged]
+    try:
+        if conn.options.transactions:
+            for file_name in new_files:
+                conn.emit(ofx.influxdb_lines(ofx.iter_file_transactions(file_name)))
+        if conn.store is not None:
+            for file_name in new_files:
+                conn.logger.info("%d new transaction(s) stored from %s",
+                                 conn.store.add_file(file_name), file_name)
+            conn.store.add_balances(conn.get_accounts(), time.time())
+    finally:
+        for delta_file in conn.sync_deltas.values():
+            os.remove(delta_file)
+    conn.emit_metrics()
+    if [error for _, _, error in summary if error is not None]:
+        sys.exit(1)
+
+def main():
+    """Main function"""
+    conn = DesjardinsConnection(get_args())
+    exit_code = 0
+    try:
+        run(conn)
+    except SystemExit as exp:
+        exit_code = exp.code
+    except DesjardinsError as exp:
+        print "{}".format(exp)
+        exit_code = exp.exit_code
+    except requests.RequestException as exp:
+        print "Network error: {}".format(exp)
+        exit_code = NETWORK_EXIT_CODE
+    # Points are sent on every exit, the daemon and the exporter included
+    if not conn.close() and not exit_code:
+        exit_code = INFLUXDB_EXIT_CODE
+    sys.exit(exit_code)
 
 if __name__ == '__main__':
     main()
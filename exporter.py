@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Serve account balances to scrapers
+* Balances are kept in memory, rendered once by refresh
+  in Prometheus (/metrics) and influxDB (/influxdb) text formats
+* A single background thread refreshes them, at most once by interval
+  and only when a scrape finds them stale (stale-while-revalidate)
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import logging
+import threading
+import time
+
+PROMETHEUS_LABELS = ("fullname", "category", "type", "id", "caisse", "description")
+PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+INFLUXDB_TYPE = "text/plain; charset=utf-8"
+
+
+def escape_label(value):
+    """Escape a Prometheus label value"""
+    return u"{}".format(value).replace(u"\\", u"\\\\").replace(u'"', u'\\"') \
+                              .replace(u"\n", u"\\n")
+
+def prometheus_text(accounts, updated_at, errors):
+    """Return balances and refresh metrics in Prometheus text format"""
+    lines = [u"# HELP desjardins_balance Account balance in dollars",
+             u"# TYPE desjardins_balance gauge"]
+    for account in accounts:
+        labels = u",".join(u'{}="{}"'.format(key, escape_label(account[key]))
+                           for key in PROMETHEUS_LABELS if account.get(key) is not None)
+        lines.append(u"desjardins_balance{%s} %r" % (labels, round(account["balance"], 2)))
+    lines.append(u"# HELP desjardins_balance_updated_seconds Time of the last refresh")
+    lines.append(u"# TYPE desjardins_balance_updated_seconds gauge")
+    lines.append(u"desjardins_balance_updated_seconds %.3f" % (updated_at or 0))
+    lines.append(u"# HELP desjardins_refresh_errors_total Failed balance refreshes")
+    lines.append(u"# TYPE desjardins_refresh_errors_total counter")
+    lines.append(u"desjardins_refresh_errors_total %d" % errors)
+    return (u"\n".join(lines) + u"\n").encode("utf-8")
+
+
+class BalanceCache(object):
+    """Latest balances rendered in each export format
+    fetch returns the account list, influxdb_lines renders it as points,
+    refreshes stop after a fatal exception (e.g. refused credentials),
+    kept in error, and nothing is served anymore
+    Scrapes never wait for the bank: a stale cache is served
+    and wakes the refresher, concurrent scrapes share one refresh
+    """
+    def __init__(self, fetch, influxdb_lines, interval=60, fatal=(), logger=None):
+        self.fetch = fetch
+        self.fatal = fatal
+        self.influxdb_lines = influxdb_lines
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.accounts = []
+        self.updated_at = None
+        self.errors = 0
+        self.refreshes = 0
+        self.error = None
+        # Rendered pages by path, replaced as a whole
+        self.pages = {}
+        self._attempted_at = 0
+        self._wake = threading.Event()
+        self._wake.set()
+        self._thread = threading.Thread(target=self._run, name="refresher")
+        self._thread.daemon = True
+
+    def start(self):
+        """Start the refresher, the first refresh starts right away"""
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """Wait for the refresher to stop, return True if it stopped"""
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def get(self, path):
+        """Return the rendered page of path
+        None before the first refresh and once refreshes stopped
+        """
+        if self.error is not None:
+            return None
+        if self.updated_at is None or time.time() - self.updated_at >= self.interval:
+            self._wake.set()
+        return self.pages.get(path)
+
+    def _render(self):
+        """Render the pages of the current balances"""
+        influxdb = u"\n".join(self.influxdb_lines(self.accounts, self.updated_at))
+        self.pages = {"/metrics": (PROMETHEUS_TYPE,
+                                   prometheus_text(self.accounts, self.updated_at,
+                                                   self.errors)),
+                      "/influxdb": (INFLUXDB_TYPE, (influxdb + u"\n").encode("utf-8"))}
+
+    def refresh(self):
+        """Fetch the balances and render them"""
+        try:
+            self.accounts = self.fetch()
+            self.updated_at = time.time()
+            self.refreshes += 1
+        except self.fatal:
+            self.errors += 1
+            self._render()
+            raise
+        except Exception as exp:
+            # Keep serving the last balances
+            self.errors += 1
+            self.logger.error("Error refreshing balances: %s", exp)
+        self._render()
+
+    def _run(self):
+        """Refresh when woken, at most once by interval"""
+        while True:
+            self._wake.wait()
+            delay = self._attempted_at + self.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            # Scrapes received meanwhile are served by this refresh
+            self._wake.clear()
+            self._attempted_at = time.time()
+            try:
+                self.refresh()
+            except self.fatal as exp:
+                self.logger.fatal("Balances are not refreshed anymore: %s", exp)
+                self.error = exp
+                return
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+    """Serve the rendered pages of the balance cache"""
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        self.server.cache.logger.debug(format, *args)
+
+    def do_GET(self):
+        """Serve /metrics and /influxdb"""
+        path = self.path.split("?", 1)[0]
+        if path not in ("/metrics", "/influxdb"):
+            status, content_type, body = 404, "text/plain", "Not found\n"
+        else:
+            page = self.server.cache.get(path)
+            if page is None:
+                status, content_type, body = 503, "text/plain", "No balances\n"
+            else:
+                status = 200
+                content_type, body = page
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ExporterServer(ThreadingMixIn, HTTPServer):
+    """Threaded exporter server"""
+    daemon_threads = True
+
+    def __init__(self, address, cache):
+        HTTPServer.__init__(self, address, ExporterHandler)
+        self.cache = cache
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Run several profiles in one process
+* Each profile has its own credentials, cookies and output directory
+* Requests are rate limited by host and capped across all profiles
+* Balances, metrics and transactions are written to one influxDB output
+  tagged by profile, ofx files are downloaded in OUTPUT_DIR/<profile>
+
+Profiles are python files of the config directory in the settings.py
+format, with optional desjardins.py arguments of the profile:
+
+    options = ["-A", "--since", "2016-01-01"]
+
+Unknown options are passed to every profile (e.g. fleet.py -j 2 -A -z)
+"""
+
+import argparse
+import glob
+import imp
+import os
+from multiprocessing.pool import ThreadPool
+import sys
+import time
+
+import desjardins
+from influxsink import InfluxDBWriter
+import ofx
+from store import TransactionStore
+
+
+def load_profiles(directory):
+    """Return (name, credentials, options) of the profiles of directory"""
+    profiles = []
+    for file_name in sorted(glob.glob(os.path.join(directory, "*.py"))):
+        name = os.path.splitext(os.path.basename(file_name))[0]
+        module = imp.load_source("profile_" + name, file_name)
+        profiles.append((name, desjardins.get_credentials(module),
+                         list(getattr(module, "options", []))))
+    return profiles
+
+def profile_options(name, profile_args, options, connection_args):
+    """Return the desjardins.py options of a profile
+    Output, sync, session, record and archive files are separated by profile
+    """
+    output_dir = os.path.join(options.output_dir, name)
+    conn_options = desjardins.get_args(connection_args + profile_args +
+                                       ["-L", options.log_level, "-o", output_dir])
+    if conn_options.sync_dir is not None:
+        conn_options.sync_dir = os.path.join(conn_options.sync_dir, name)
+    if conn_options.session_file is not None:
+        conn_options.session_file += "." + name
+    if conn_options.record is not None:
+        conn_options.record = os.path.join(conn_options.record, name)
+    if conn_options.archive is not None:
+        conn_options.archive = os.path.join(conn_options.archive, name)
+    for directory in (conn_options.output_dir, conn_options.sync_dir):
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+    return conn_options
+
+def run_profile(profile, options, connection_args, limiter):
+    """Get balances or download ofx files of a profile
+    Return a result dict, errors are reported in result["error"]
+    """
+    name, credentials, profile_args = profile
+    result = {"profile": name, "lines": [], "accounts": [], "summary": [], "error": None}
+    conn = None
+    try:
+        conn_options = profile_options(name, profile_args, options, connection_args)
+        conn = desjardins.DesjardinsConnection(conn_options, credentials, limiter,
+                                               name="desjardins." + name)
+        conn.connect()
+        if options.influxdb:
+            result["accounts"] = conn.get_accounts()
+            result["lines"] = desjardins.influxdb_lines(result["accounts"], time.time(), name)
+        else:
+            conn.list_ofx_account()
+            if conn_options.all_accounts:
+                accounts = sorted(conn.accounts.keys())
+            else:
+                accounts = conn_options.account
+            missing = [account for account in accounts or [] if account not in conn.accounts]
+            if not accounts or missing:
+                raise ValueError("Account not found: {}".format(", ".join(missing)))
+            result["summary"] = [(conn.accounts[account][1], file_name, error,
+                                  account in conn.unchanged,
+                                  conn.sync_deltas.get(account, file_name))
+                                 for account, file_name, error in conn.download_ofx(accounts)]
+        conn.log_stats()
+    except SystemExit as exp:
+        # -l lists the accounts and exits
+        result["error"] = "exit code {}".format(exp.code)
+    except Exception as exp:
+        result["error"] = "{}: {}".format(exp.__class__.__name__, exp)
+    finally:
+        if conn is not None:
+            if options.metrics:
+                result["lines"] += desjardins.metrics_lines(conn.sessions.history,
+                                                            conn.events, name)
+            conn.sessions.close()
+    return result
+
+def emit(writer, lines):
+    """Write influxDB points to the server or print them"""
+    if writer is not None:
+        writer.write(lines)
+        return
+    for line in lines:
+        print "{}".format(line.encode("utf-8"))
+
+def get_args(args=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Run several Desjardins profiles')
+    parser.add_argument('-c', '--config-dir', dest='config_dir', required=False,
+                        default='profiles',
+                        help="Directory of the profile files")
+    parser.add_argument('-j', '--concurrency', dest='concurrency', required=False,
+                        type=int, default=4,
+                        help="Profiles run at the same time")
+    parser.add_argument('--host-rate', dest='host_rate', required=False,
+                        type=float, default=5,
+                        help="Most requests by second to each host, all profiles included")
+    parser.add_argument('--max-requests', dest='max_requests', required=False,
+                        type=int, default=8,
+                        help="Most requests in flight, all profiles included")
+    parser.add_argument('-o', '--output-dir', dest='output_dir', required=False,
+                        default='/tmp',
+                        help="Ofx files are downloaded in a sub directory by profile")
+    parser.add_argument('-i', '--influxdb', dest='influxdb', required=False,
+                        action='store_true', default=False,
+                        help="Output balances of all profiles in influxDB format")
+    parser.add_argument('-T', '--transactions', dest='transactions', required=False,
+                        action='store_true', default=False,
+                        help="Write transactions of downloaded statements as influxDB points")
+    parser.add_argument('-m', '--metrics', dest='metrics', required=False,
+                        action='store_true', default=False,
+                        help="Output request metrics in influxDB format")
+    parser.add_argument('-u', '--influxdb-url', dest='influxdb_url', required=False,
+                        help="Send influxDB points to this server instead of printing them")
+    parser.add_argument('--influxdb-db', dest='influxdb_db', required=False,
+                        default='desjardins')
+    parser.add_argument('--influxdb-spool', dest='influxdb_spool', required=False,
+                        help="Directory where points are kept while InfluxDB is unreachable")
+    parser.add_argument('--store', dest='store', required=False,
+                        help="Add transactions and balances to this SQLite database")
+    parser.add_argument('-L', '--log-level', dest='log_level', required=False,
+                        default='FATAL')
+    return parser.parse_known_args(args)
+
+def main():
+    """Main function"""
+    options, connection_args = get_args()
+    profiles = load_profiles(options.config_dir)
+    if not profiles:
+        print "No profile found in {}".format(options.config_dir)
+        sys.exit(0)
+    limiter = desjardins.HostLimiter(options.host_rate, options.max_requests)
+    writer = None
+    if options.influxdb_url is not None:
+        writer = InfluxDBWriter(options.influxdb_url, options.influxdb_db,
+                                spool_dir=options.influxdb_spool)
+    store = None
+    if options.store is not None:
+        store = TransactionStore(options.store)
+
+    # Profiles wait on the network, threads share the host limiter
+    # and keep one cookie jar by profile
+    pool = ThreadPool(max(1, min(options.concurrency, len(profiles))))
+    failed = False
+    try:
+        for result in pool.imap_unordered(
+                lambda profile: run_profile(profile, options, connection_args, limiter),
+                profiles):
+            name = result["profile"]
+            emit(writer, result["lines"])
+            if store is not None and result["accounts"]:
+                store.add_balances(result["accounts"], time.time())
+            for account, file_name, error, unchanged, new_file in result["summary"]:
+                if error is not None:
+                    failed = True
+                    print u"{}: {} failed: {}".format(name, account, error).encode("utf-8")
+                    continue
+                if unchanged:
+                    print u"{}: {} unchanged, latest in {}".format(
+                        name, account, file_name).encode("utf-8")
+                    continue
+                print u"{}: {} saved in {}".format(name, account, file_name).encode("utf-8")
+                # Only the added transactions of synced statements are new
+                if options.transactions:
+                    emit(writer, ofx.influxdb_lines(ofx.iter_file_transactions(new_file),
+                                                    profile=name))
+                if store is not None:
+                    store.add_file(new_file)
+            for _, file_name, _, _, new_file in result["summary"]:
+                if new_file != file_name:
+                    os.remove(new_file)
+            if result["error"] is not None:
+                failed = True
+                print u"{}: failed: {}".format(name, result["error"]).encode("utf-8")
+    finally:
+        pool.close()
+        pool.join()
+        if writer is not None and not writer.close():
+            failed = True
+            print "InfluxDB points lost: {}, batches rejected: {}".format(writer.lost,
+                                                                          writer.rejected)
+        if store is not None:
+            store.close()
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
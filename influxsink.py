@@ -0,0 +1,186 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Write points to InfluxDB
+* Build line protocol points with correct escaping
+* Batch and gzip points to the /write endpoint with retries
+* Spool points on disk while InfluxDB is unreachable,
+  keep batches InfluxDB rejects in the rejected sub directory
+"""
+
+import gzip
+import logging
+import os
+from StringIO import StringIO
+import time
+import uuid
+from collections import deque
+
+import requests
+
+# Results of a batch write
+SENT = "sent"
+REJECTED = "rejected"
+UNREACHABLE = "unreachable"
+
+
+def escape_measurement(value):
+    """Escape an influxDB measurement name"""
+    value = u"{}".format(value)
+    for char in (u",", u" "):
+        value = value.replace(char, u"\\" + char)
+    return value
+
+def escape_tag(value):
+    """Escape an influxDB tag key, tag value or field key"""
+    value = u"{}".format(value)
+    for char in (u",", u"=", u" "):
+        value = value.replace(char, u"\\" + char)
+    return value
+
+def format_field(value):
+    """Format an influxDB field value"""
+    if isinstance(value, bool):
+        return u"true" if value else u"false"
+    if isinstance(value, (int, long)):
+        return u"{}i".format(value)
+    if isinstance(value, float):
+        return repr(value)
+    value = u"{}".format(value)
+    return u'"{}"'.format(value.replace(u"\\", u"\\\\").replace(u'"', u'\\"'))
+
+def make_line(measurement, tags, fields, timestamp=None):
+    """Build a line protocol point
+    tags and fields are lists of (key, value), timestamp is in seconds
+    Tags with None or empty values are skipped
+    """
+    line = escape_measurement(measurement)
+    for key, value in tags:
+        if value is not None and value != u"":
+            line += u",{}={}".format(escape_tag(key), escape_tag(value))
+    line += u" " + u",".join(u"{}={}".format(escape_tag(key), format_field(value))
+                             for key, value in fields)
+    if timestamp is not None:
+        line += u" {:d}".format(int(round(timestamp * 1e9)))
+    return line
+
+
+class InfluxDBWriter(object):
+    """Batched and gzip compressed InfluxDB writer"""
+    def __init__(self, url, database, batch_size=500, max_buffer=10000,
+                 spool_dir=None, retries=3, timeout=10, logger=None):
+        self.url = url.rstrip("/") + "/write"
+        self.database = database
+        self.batch_size = batch_size
+        self.spool_dir = spool_dir
+        self.retries = retries
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger(__name__)
+        # Oldest points are dropped when the buffer is full
+        self.buffer = deque(maxlen=max_buffer)
+        # Batches InfluxDB refused, points dropped or not spooled
+        self.rejected = 0
+        self.lost = 0
+        self.session = requests.Session()
+        if spool_dir is not None and not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+
+    def write(self, lines):
+        """Add points to the buffer, send them when a batch is full
+        lines can be a generator, it is consumed one batch at a time
+        """
+        for line in lines:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.logger.warning("InfluxDB buffer full, dropping oldest point")
+                self.lost += 1
+            self.buffer.append(line)
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+
+    def _post(self, body):
+        """Send a gzip compressed batch, retry with backoff
+        Return SENT, REJECTED or UNREACHABLE
+        """
+        for attempt in range(self.retries):
+            try:
+                res = self.session.post(self.url, data=body, timeout=self.timeout,
+                                        params={"db": self.database, "precision": "ns"},
+                                        headers={"Content-Encoding": "gzip",
+                                                 "Content-Type": "text/plain; charset=utf-8"})
+                if res.status_code < 300:
+                    return SENT
+                if res.status_code < 500:
+                    # Bad points, retrying will not help
+                    self.logger.error("InfluxDB rejected points: %s", res.text)
+                    return REJECTED
+                self.logger.warning("InfluxDB error %d", res.status_code)
+            except requests.RequestException as exp:
+                self.logger.warning("InfluxDB unreachable: %s", exp)
+            if attempt + 1 < self.retries:
+                time.sleep(2 ** attempt)
+        return UNREACHABLE
+
+    def _spool(self, body, rejected=False, points=0):
+        """Save a batch of points which can not be sent
+        Rejected batches are kept aside and not sent again
+        """
+        if rejected:
+            self.rejected += 1
+        if self.spool_dir is None:
+            self.logger.error("%d point(s) lost, no spool directory", points)
+            self.lost += points
+            return
+        directory = self.spool_dir
+        if rejected:
+            directory = os.path.join(self.spool_dir, "rejected")
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        file_name = os.path.join(directory, "%d-%s.lp.gz" % (time.time(), uuid.uuid4().hex))
+        with open(file_name + ".tmp", "wb") as spool_file:
+            spool_file.write(body)
+        os.rename(file_name + ".tmp", file_name)
+        self.logger.warning("Points %s in %s", "kept" if rejected else "spooled", file_name)
+
+    def _send_spool(self):
+        """Send spooled batches, oldest first
+        Return False if InfluxDB is still unreachable
+        """
+        if self.spool_dir is None:
+            return True
+        for file_name in sorted(os.listdir(self.spool_dir)):
+            if not file_name.endswith(".lp.gz"):
+                continue
+            file_name = os.path.join(self.spool_dir, file_name)
+            with open(file_name, "rb") as spool_file:
+                body = spool_file.read()
+            result = self._post(body)
+            if result == UNREACHABLE:
+                return False
+            if result == REJECTED:
+                self._spool(body, rejected=True)
+            os.remove(file_name)
+        return True
+
+    def flush(self):
+        """Send all buffered points"""
+        while self.buffer:
+            lines = [self.buffer.popleft()
+                     for _ in range(min(self.batch_size, len(self.buffer)))]
+            body = StringIO()
+            with gzip.GzipFile(fileobj=body, mode="wb") as gzip_file:
+                gzip_file.write(u"\n".join(lines).encode("utf-8") + "\n")
+            body = body.getvalue()
+            result = UNREACHABLE
+            if self._send_spool():
+                result = self._post(body)
+            if result != SENT:
+                self._spool(body, rejected=result == REJECTED, points=len(lines))
+
+    def close(self):
+        """Send remaining points and close the connection
+        Return False if points were lost or rejected
+        """
+        self.flush()
+        self.session.close()
+        if self.rejected:
+            self.logger.error("%d batch(es) rejected by InfluxDB", self.rejected)
+        return not self.lost and not self.rejected
@@ -0,0 +1,344 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Local stand-in for the AccesD and VISA websites
+* Serve the pages used by DesjardinsConnection with synthetic data
+* Configurable account count, ofx size, latency and GET error rate
+* Count requests and bytes sent
+* Accept InfluxDB /write requests
+* Log in with the fake CREDENTIALS, never with real ones
+"""
+
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import Cookie
+import datetime
+import gzip
+import random
+import ssl
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+import threading
+import time
+import urlparse
+import uuid
+
+# Fake credentials, in the desjardins.get_credentials format
+CREDENTIALS = {"number": "0000000000000000",
+               "password": "mockpassword",
+               "secure_phrase": "Mock secure phrase",
+               "questions": {u"Mock question?": "Mock answer"}}
+
+
+def html_page(body):
+    """Wrap body in an html page"""
+    return (u"<html><head><meta http-equiv='Content-Type' "
+            u"content='text/html; charset=utf-8'/><title>Desjardins</title></head>"
+            u"<body>%s</body></html>" % body).encode("utf-8")
+
+def hidden_form(action, fields):
+    """Build a form with hidden inputs"""
+    inputs = u"".join(u"<input type='hidden' name='%s' value='%s'/>" % field
+                      for field in sorted(fields.items()))
+    return u"<form method='post' action='%s'>%s</form>" % (action, inputs)
+
+def make_summary_page(holdings, panels=4):
+    """Build a synthetic account summary page with holdings accounts"""
+    html = [hidden_form("/sommaire-perso/sommaire/detention", {"token": "1"})]
+    categories = [u"Comptes", u"Placements", u"Cartes pr\xeats et marges de cr\xe9dit",
+                  u"Assurances"]
+    for panel in range(panels):
+        html.append(u"<div class='panel panel-tiroir'><div><h2><a>"
+                    u"<span>Ouvrir</span> <span>le tiroir</span> <span>%s</span>"
+                    u"</a></h2></div><div>" % categories[panel % len(categories)])
+        for holding in range(panel, holdings, panels):
+            html.append(u"<div class='section tiroir'><div><h3>%06d EOP Compte %d</h3>"
+                        u"<p><span class='desc-ligne1'>Description\xa0%d</span>"
+                        u"<span class='desc-ligne2'>Caisse Desjardins</span></p>"
+                        u"<div><span class='montant'>%d,%02d\xa0$</span></div>"
+                        u"</div></div>" % (holding, holding, holding, holding, holding % 100))
+        html.append(u"</div></div>")
+    return html_page(u"".join(html))
+
+def make_ofx_account_page(accounts):
+    """Build the ofx account selection page"""
+    rows = [u"<tr><td><input type='checkbox' name='chCompte%d'/></td>"
+            u"<td class='c'><span>815</span><span>30000</span><span>%06d</span>"
+            u"<span>EOP</span></td></tr>" % (account, account)
+            for account in range(accounts)]
+    form = hidden_form("/coreleADReleve/ObtenirSelectionConciliationBancaire.do",
+                       {"msgId": "valider"})
+    return html_page(form[:-len(u"</form>")] + u"<table>%s</table></form>" % u"".join(rows))
+
+def make_ofx(account, start_date, end_date, transactions_per_day, visa=False):
+    """Build a synthetic ofx statement
+    FITIDs only depend on the account and the posted date
+    so overlapping statements share their transactions
+    """
+    transactions = []
+    day = start_date
+    while day <= end_date:
+        for index in range(transactions_per_day):
+            transactions.append(
+                "<STMTTRN>\r\n<TRNTYPE>DEBIT\r\n<DTPOSTED>%(date)s\r\n<TRNAMT>-%(amount)d.%(cents)02d\r\n"
+                "<FITID>%(account)s%(date)s%(index)03d\r\n<NAME>Marchand %(index)d\r\n"
+                "<MEMO>Achat %(date)s\r\n</STMTTRN>\r\n" %
+                {"date": day.strftime("%Y%m%d"), "amount": index + 1, "cents": day.day,
+                 "account": account, "index": index})
+        day += datetime.timedelta(days=1)
+    if visa:
+        account_from = "<CCACCTFROM>\r\n<ACCTID>%s\r\n</CCACCTFROM>\r\n" % account
+        statement = ("CREDITCARDMSGSRSV1", "CCSTMTTRNRS", "CCSTMTRS")
+    else:
+        account_from = ("<BANKACCTFROM>\r\n<BANKID>815\r\n<ACCTID>%s\r\n"
+                        "<ACCTTYPE>CHECKING\r\n</BANKACCTFROM>\r\n" % account)
+        statement = ("BANKMSGSRSV1", "STMTTRNRS", "STMTRS")
+    return ("OFXHEADER:100\r\nDATA:OFXSGML\r\nVERSION:102\r\nSECURITY:NONE\r\n"
+            "ENCODING:USASCII\r\nCHARSET:1252\r\nCOMPRESSION:NONE\r\nOLDFILEUID:NONE\r\n"
+            "NEWFILEUID:NONE\r\n\r\n<OFX>\r\n<SIGNONMSGSRSV1>\r\n<SONRS>\r\n<STATUS>\r\n"
+            "<CODE>0\r\n<SEVERITY>INFO\r\n</STATUS>\r\n<DTSERVER>%(now)s\r\n<LANGUAGE>FRA\r\n"
+            "</SONRS>\r\n</SIGNONMSGSRSV1>\r\n<%(msgs)s>\r\n<%(trnrs)s>\r\n<TRNUID>0\r\n"
+            "<STATUS>\r\n<CODE>0\r\n<SEVERITY>INFO\r\n</STATUS>\r\n<%(stmtrs)s>\r\n"
+            "<CURDEF>CAD\r\n%(from)s<BANKTRANLIST>\r\n<DTSTART>%(start)s\r\n<DTEND>%(end)s\r\n"
+            "%(transactions)s</BANKTRANLIST>\r\n<LEDGERBAL>\r\n<BALAMT>1000.00\r\n"
+            "<DTASOF>%(end)s\r\n</LEDGERBAL>\r\n</%(stmtrs)s>\r\n</%(trnrs)s>\r\n"
+            "</%(msgs)s>\r\n</OFX>\r\n" %
+            {"now": datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
+             "msgs": statement[0], "trnrs": statement[1], "stmtrs": statement[2],
+             "from": account_from, "start": start_date.strftime("%Y%m%d"),
+             "end": end_date.strftime("%Y%m%d"), "transactions": "".join(transactions)})
+
+def form_date(form, day, month, year):
+    """Read a date from form fields"""
+    return datetime.datetime(int(form[year]), int(form[month]), int(form[day]))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Serve AccesD and VISA pages"""
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_body(self, body, status=200, content_type="text/html; charset=utf-8",
+                  headers=None):
+        """Send a complete response after the configured latency"""
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(self.path, len(body))
+
+    def session(self):
+        """Return the server side session of the client or None"""
+        cookie = Cookie.SimpleCookie(self.headers.get("Cookie", ""))
+        if "MOCKSESSION" not in cookie:
+            return None
+        return self.server.sessions.get(cookie["MOCKSESSION"].value)
+
+    def read_form(self):
+        """Read posted form fields"""
+        length = int(self.headers.get("Content-Length", 0))
+        form = urlparse.parse_qs(self.rfile.read(length), keep_blank_values=True)
+        return dict((key, values[-1]) for key, values in form.items())
+
+    def query(self):
+        """Read query string fields"""
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query, keep_blank_values=True)
+        return dict((key, values[-1]) for key, values in query.items())
+
+    def do_GET(self):
+        """Serve GET requests"""
+        path = urlparse.urlparse(self.path).path
+        query = self.query()
+        server = self.server
+        if random.random() < server.error_rate:
+            self.send_body(html_page(u"Service unavailable"), status=503)
+        elif path == "/identifiantunique/identification":
+            self.send_body(html_page(hidden_form("identificationProcess", {"etape": "1"})))
+        elif path == "/identifiantunique/defi":
+            question = sorted(CREDENTIALS["questions"])[0]
+            self.send_body(html_page(
+                u"<form><label for='valeurReponse'><b>%s</b></label>%s</form>" %
+                (question, hidden_form("soumettre", {"etape": "2"}))))
+        elif path == "/identifiantunique/authentification":
+            self.send_body(html_page(
+                u"<form><div><img src='/identifiantunique/image'/><strong>%s</strong></div>"
+                u"%s</form>" % (CREDENTIALS["secure_phrase"],
+                                hidden_form("authentificationProcess", {"etape": "3"}))))
+        elif path == "/identifiantunique/image":
+            self.send_body("GIF89a", content_type="image/gif")
+        elif path == "/identifiantunique/sso/redirect":
+            self.send_body(html_page(hidden_form("LogonSSOviaAccesWeb.do", {"jeton": "sso"})))
+        elif self.session() is None:
+            # Session expired
+            self.send_body("", status=302,
+                           headers={"Location": "/identifiantunique/identification"})
+        elif path == "/sommaire-perso/sommaire/detention":
+            self.send_body(make_summary_page(server.accounts))
+        elif path == "/coreleADReleve/ObtenirSelectionConciliationBancaire.do":
+            self.send_body(make_ofx_account_page(server.accounts))
+        elif path == "/coreleADReleve/secondaire/ObtenirReleveOperations.do":
+            selection = self.session().get("selection")
+            if selection is None:
+                self.send_body(html_page(u"<span id='erreurSystem'>Aucun compte</span>"))
+                return
+            self.send_body(make_ofx("%06d" % selection[0], selection[1], selection[2],
+                                    server.transactions),
+                           content_type="application/x-ofx")
+        elif path == "/cooperADOperations/ObtenirInfoCartes.do":
+            self.send_body(html_page(hidden_form("/GCE/SALogonAccesD", {"jeton": "visa"})))
+        elif path == "/GCE/SAInfoCpte":
+            msgid = query.get("MSGID")
+            if msgid == "etatActuelCpte":
+                self.send_body(html_page(
+                    u"<table><tr><td><a class='me' href='GCE/SAInfoCpte?MSGID=releve&amp;"
+                    u"CLIENT=HTML'>Relev\xe9 de compte</a></td></tr></table>"))
+            elif msgid == "releve":
+                self.send_body(html_page(
+                    u"<a class='mse' href='GCE/SAInfoCpte?MSGID=conciliation&amp;CLIENT=HTML'>"
+                    u"Conciliation / T\xe9l\xe9chargement</a>"))
+            else:
+                self.send_body(html_page(hidden_form("/GCE/SAInfoCpte", {"MSGID": "telecharger"})))
+        else:
+            self.send_body(html_page(u"Not found"), status=404)
+
+    def write_points(self):
+        """Store InfluxDB points"""
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        with self.server._lock:
+            self.server.points.extend(line for line in body.splitlines() if line)
+        self.send_body("", status=204)
+
+    def do_POST(self):
+        """Serve POST requests"""
+        path = urlparse.urlparse(self.path).path
+        if path == "/write":
+            self.write_points()
+            return
+        form = self.read_form()
+        server = self.server
+        if path == "/identifiantunique/identification/identificationProcess":
+            self.send_body(html_page(u"Identification"))
+        elif path == "/identifiantunique/defi/soumettre":
+            self.send_body(html_page(u"Defi"))
+        elif path == "/identifiantunique/authentification/authentificationProcess":
+            session_id = uuid.uuid4().hex
+            server.sessions[session_id] = {}
+            self.send_body(html_page(u"Authentification"),
+                           headers={"Set-Cookie": "MOCKSESSION=%s; Path=/" % session_id})
+        elif self.session() is None:
+            self.send_body("", status=302,
+                           headers={"Location": "/identifiantunique/identification"})
+        elif path == "/tisecuADGestionAcces/LogonSSOviaAccesWeb.do":
+            self.send_body(html_page(hidden_form("/auportADPortail/ObtenirPageAccueilADP.do",
+                                                 {"jeton": "portail"})))
+        elif path == "/auportADPortail/ObtenirPageAccueilADP.do":
+            self.send_body(html_page(u"Accueil"))
+        elif path == "/coreleADReleve/ObtenirSelectionConciliationBancaire.do":
+            selected = [int(key[len("chCompte"):]) for key in form
+                        if key.startswith("chCompte")]
+            self.session()["selection"] = (
+                selected[0],
+                form_date(form, "chDateJourMin", "chDateMoisMin", "chDateAnneeMin"),
+                form_date(form, "chDateJourMax", "chDateMoisMax", "chDateAnneeMax"))
+            self.send_body(html_page(u"Selection"))
+        elif path == "/GCE/SALogonAccesD":
+            self.send_body(html_page(u"VISA"))
+        elif path == "/GCE/SAInfoCpte":
+            self.send_body(make_ofx("4540000000000000",
+                                    form_date(form, "jourDebut", "moisDebut", "anneeDebut"),
+                                    form_date(form, "jourFin", "moisFin", "anneeFin"),
+                                    server.transactions, visa=True),
+                           content_type="application/x-ofx")
+        else:
+            self.send_body(html_page(u"Not found"), status=404)
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """Threaded mock AccesD and VISA server"""
+    daemon_threads = True
+
+    def __init__(self, address, accounts=5, transactions=3, latency=0,
+                 certfile=None, verbose=False, error_rate=0):
+        HTTPServer.__init__(self, address, MockHandler)
+        self.accounts = accounts
+        self.transactions = transactions
+        self.latency = latency
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.sessions = {}
+        # Received InfluxDB points
+        self.points = []
+        self.requests = 0
+        self.bytes_sent = 0
+        self.scheme = "http"
+        self._lock = threading.Lock()
+        if certfile is not None:
+            self.socket = ssl.wrap_socket(self.socket, certfile=certfile, server_side=True)
+            self.scheme = "https"
+
+    @property
+    def base_url(self):
+        """Return the url to use as --base-url"""
+        return "%s://%s:%d" % (self.scheme, self.server_address[0], self.server_address[1])
+
+    def count(self, path, size):
+        """Count a sent response"""
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def start(self):
+        """Serve requests in a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def get_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Mock AccesD and VISA server')
+    parser.add_argument('-b', '--bind', dest='bind', required=False, default="127.0.0.1")
+    parser.add_argument('-p', '--port', dest='port', required=False, type=int, default=8080)
+    parser.add_argument('-n', '--accounts', dest='accounts', required=False,
+                        type=int, default=5,
+                        help="Accounts in the summary and ofx pages")
+    parser.add_argument('-t', '--transactions', dest='transactions', required=False,
+                        type=int, default=3,
+                        help="Transactions by day in ofx statements")
+    parser.add_argument('-d', '--latency', dest='latency', required=False,
+                        type=float, default=0,
+                        help="Seconds added before each response")
+    parser.add_argument('-e', '--error-rate', dest='error_rate', required=False,
+                        type=float, default=0,
+                        help="Share of GET requests answered with a 503 error")
+    parser.add_argument('-c', '--certfile', dest='certfile', required=False,
+                        help="Serve https with this certificate (pem with its key)")
+    parser.add_argument('-v', '--verbose', dest='verbose', required=False,
+                        action='store_true', default=False)
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    options = get_args()
+    server = MockServer((options.bind, options.port), options.accounts,
+                        options.transactions, options.latency, options.certfile,
+                        options.verbose, options.error_rate)
+    print "Serving on {}".format(server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
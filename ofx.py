@@ -0,0 +1,370 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""OFX helpers
+* Merge ofx statements of the same account, streamed block by block
+* Stream transactions of SGML or XML statements with bounded memory
+  and export them to CSV or influxDB line protocol
+
+Usage: ofx.py [-f csv|influxdb] FILE...
+"""
+
+import argparse
+import calendar
+from contextlib import contextmanager
+import csv
+import datetime
+from decimal import Decimal, InvalidOperation
+import gzip
+import os
+import re
+import sys
+
+from influxsink import make_line
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DTSTART_RE = re.compile(r"(<BANKTRANLIST>\s*<DTSTART>)([^<\s]+)")
+FITID_RE = re.compile(r"<FITID>([^<\r\n]+)")
+DTPOSTED_RE = re.compile(r"<DTPOSTED>(\d{8})")
+# A tag and the text following it, the text is complete once the next tag is read
+TOKEN_RE = re.compile(r"<([^<>]*)>([^<]*)")
+XML_ENCODING_RE = re.compile(r"<\?xml[^>]*encoding=[\"']([^\"']+)")
+SGML_CHARSET_RE = re.compile(r"CHARSET:\s*(\S+)")
+ENTITIES = (("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'), ("&apos;", "'"), ("&amp;", "&"))
+CHUNK_SIZE = 64 * 1024
+
+
+def open_ofx(file_name, mode="rb"):
+    """Open an ofx file for reading
+    gzip compressed if its name ends with .gz, zstd compressed if it ends with .zst
+    """
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, mode)
+    if file_name.endswith(".zst"):
+        if zstandard is None:
+            raise IOError("zstandard module needed to read {}".format(file_name))
+        return zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"))
+    return open(file_name, mode)
+
+def read_ofx(file_name):
+    """Read an ofx file"""
+    with open_ofx(file_name) as ofx_file:
+        return ofx_file.read()
+
+def write_ofx(file_name, content):
+    """Write an ofx file in a temporary file renamed when complete
+    The file is compressed like create_ofx does
+    """
+    with create_ofx(file_name) as ofx_file:
+        ofx_file.write(content)
+
+@contextmanager
+def create_ofx(file_name):
+    """Open an ofx file for writing
+    gzip compressed if its name ends with .gz, zstd compressed if it ends with .zst
+    It is written in a temporary file renamed when the block ends without error
+    """
+    tmp_file_name = file_name + ".tmp"
+    try:
+        with open(tmp_file_name, "wb") as raw_file:
+            if file_name.endswith(".gz"):
+                with gzip.GzipFile(fileobj=raw_file, mode="wb") as ofx_file:
+                    yield ofx_file
+            elif file_name.endswith(".zst"):
+                if zstandard is None:
+                    raise IOError("zstandard module needed to write {}".format(file_name))
+                compressor = zstandard.ZstdCompressor(level=10)
+                with compressor.stream_writer(raw_file) as ofx_file:
+                    yield ofx_file
+            else:
+                yield raw_file
+        os.rename(tmp_file_name, file_name)
+    except:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+
+def iter_statement(ofx_file, chunk_size=CHUNK_SIZE):
+    """Yield (part, text) of an ofx file read by chunks
+    part is "head" up to the first transaction, "transaction" for each
+    STMTTRN block and "tail" from the end of the transaction list,
+    a file without transaction list is a single head
+    """
+    buf = ""
+    part = "head"
+    while True:
+        chunk = ofx_file.read(chunk_size)
+        buf += chunk
+        if part == "head":
+            ends = [pos for pos in (buf.find("<STMTTRN>"), buf.find("</BANKTRANLIST>"))
+                    if pos != -1]
+            if ends:
+                yield ("head", buf[:min(ends)])
+                buf = buf[min(ends):]
+                part = "transaction"
+            elif not chunk:
+                yield ("head", buf)
+                return
+        while part == "transaction":
+            if not buf.startswith("<STMTTRN>"):
+                if len(buf) < len("<STMTTRN>") and chunk:
+                    break
+                part = "tail"
+                break
+            end = buf.find("</STMTTRN>")
+            if end == -1:
+                break
+            end += len("</STMTTRN>")
+            # Keep the whitespace following the block with it
+            while end < len(buf) and buf[end].isspace():
+                end += 1
+            if end == len(buf) and chunk:
+                break
+            yield ("transaction", buf[:end])
+            buf = buf[end:]
+        if part == "tail":
+            if buf:
+                yield ("tail", buf)
+            buf = ""
+        if not chunk:
+            if buf:
+                # Truncated transaction list
+                yield ("tail", buf)
+            return
+
+def read_head(file_name):
+    """Return (head, True if the file has a transaction list) of an ofx file"""
+    with open_ofx(file_name) as ofx_file:
+        parts = iter_statement(ofx_file)
+        _, head = next(parts)
+        return (head, next(parts, None) is not None)
+
+@contextmanager
+def null_ofx():
+    """Stand-in of create_ofx when there is no file to write"""
+    yield None
+
+def merge_ofx_files(file_names, file_name, new_file_name=None):
+    """Merge statements of the same account, oldest first, in file_name
+    Files are streamed: transactions are deduplicated by FITID, the first one
+    is kept, headers and balances come from the newest statement
+    with the oldest start date
+    Transactions added by the last file are also written to new_file_name
+    as a statement, e.g. the new transactions of a sync
+    Return (new transactions by file, (last posted date, its FITID))
+    the high-water mark is (None, None) if there is no transaction
+    """
+    heads = [read_head(name) for name in file_names]
+    statements = [name for name, (_, has_list) in zip(file_names, heads) if has_list]
+    newest = statements[-1] if statements else file_names[-1]
+    head = new_head = heads[file_names.index(newest)][0]
+    starts = [match.group(2) for match in
+              (DTSTART_RE.search(file_head) for file_head, has_list in heads if has_list)
+              if match is not None]
+    if starts and DTSTART_RE.search(head) is not None:
+        head = DTSTART_RE.sub(lambda m: m.group(1) + min(starts), head, count=1)
+
+    fitids = set()
+    added = []
+    mark = None
+    with create_ofx(file_name) as out_file, \
+            (create_ofx(new_file_name) if new_file_name else null_ofx()) as new_file:
+        out_file.write(head)
+        if new_file is not None:
+            new_file.write(new_head)
+        for name in file_names:
+            count = 0
+            if name in statements:
+                with open_ofx(name) as ofx_file:
+                    for part, block in iter_statement(ofx_file):
+                        if part != "transaction":
+                            continue
+                        fitid = FITID_RE.search(block)
+                        dtposted = DTPOSTED_RE.search(block)
+                        if fitid is None or dtposted is None or \
+                                fitid.group(1).strip() in fitids:
+                            continue
+                        fitids.add(fitid.group(1).strip())
+                        mark = max(mark, (dtposted.group(1), fitid.group(1).strip()))
+                        out_file.write(block)
+                        if new_file is not None and name == file_names[-1]:
+                            new_file.write(block)
+                        count += 1
+            added.append(count)
+        if statements:
+            with open_ofx(newest) as ofx_file:
+                for part, text in iter_statement(ofx_file):
+                    if part == "tail":
+                        out_file.write(text)
+                        if new_file is not None:
+                            new_file.write(text)
+    if mark is None:
+        return (added, (None, None))
+    return (added, (datetime.datetime.strptime(mark[0], "%Y%m%d"), mark[1]))
+
+
+class Transaction(object):
+    """Transaction of an ofx statement"""
+    __slots__ = ("account", "date", "amount", "fitid", "payee", "memo", "trntype")
+    FIELDS = __slots__
+
+    def __init__(self, account=None, date=None, amount=None, fitid=None,
+                 payee=None, memo=None, trntype=None):
+        self.account = account
+        self.date = date
+        self.amount = amount
+        self.fitid = fitid
+        self.payee = payee
+        self.memo = memo
+        self.trntype = trntype
+
+    def __repr__(self):
+        return "Transaction({})".format(", ".join(
+            "{}={!r}".format(field, getattr(self, field)) for field in self.FIELDS))
+
+def get_encoding(header):
+    """Return the text encoding declared in an ofx header"""
+    match = XML_ENCODING_RE.search(header)
+    if match is not None:
+        return match.group(1)
+    match = SGML_CHARSET_RE.search(header)
+    if match is not None and match.group(1).isdigit():
+        return "cp" + match.group(1)
+    if match is not None and match.group(1).upper() != "NONE":
+        return match.group(1)
+    if header.startswith("<?xml"):
+        return "utf-8"
+    return "cp1252"
+
+def decode_value(value, encoding):
+    """Decode and unescape an element value"""
+    value = value.strip()
+    if "&" in value:
+        for entity, char in ENTITIES:
+            value = value.replace(entity, char)
+    return value.decode(encoding, "replace")
+
+def parse_date(value):
+    """Return the date of an ofx date time"""
+    try:
+        return datetime.date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+    except ValueError:
+        return None
+
+def iter_tokens(ofx_file, chunk_size=CHUNK_SIZE):
+    """Yield (tag, text) of an ofx file read by chunks
+    The SGML header before the first tag is the text of a None tag
+    """
+    buf = ""
+    header = True
+    while True:
+        chunk = ofx_file.read(chunk_size)
+        buf += chunk
+        if header:
+            start = buf.find("<")
+            if start == -1 and chunk:
+                continue
+            yield (None, buf[:start] if start != -1 else buf)
+            buf = buf[start:] if start != -1 else ""
+            header = False
+        pos = 0
+        for match in TOKEN_RE.finditer(buf):
+            if chunk and match.end() == len(buf):
+                # The text may continue in the next chunk
+                break
+            yield match.groups()
+            pos = match.end()
+        buf = buf[pos:]
+        if not chunk:
+            return
+
+def iter_transactions(ofx_file, account=None, chunk_size=CHUNK_SIZE):
+    """Yield transactions of an ofx file object
+    The statement is read by chunks, SGML (unclosed elements) and XML are supported
+    account defaults to the ACCTID of the statement
+    """
+    encoding = "cp1252"
+    current_account = account
+    transaction = None
+    for tag, text in iter_tokens(ofx_file, chunk_size):
+        if tag is None or tag.startswith("?xml"):
+            encoding = get_encoding(text if tag is None else "<" + tag)
+            continue
+        if tag == "STMTTRN":
+            transaction = Transaction(account=current_account)
+        elif tag == "/STMTTRN":
+            if transaction is not None and transaction.fitid is not None:
+                yield transaction
+            transaction = None
+        elif tag == "ACCTID" and account is None:
+            current_account = decode_value(text, encoding)
+        elif transaction is None or tag.startswith("/"):
+            continue
+        elif tag == "DTPOSTED":
+            transaction.date = parse_date(text.strip())
+        elif tag == "TRNAMT":
+            try:
+                transaction.amount = Decimal(text.strip().replace(",", "."))
+            except InvalidOperation:
+                transaction.amount = None
+        elif tag == "FITID":
+            transaction.fitid = decode_value(text, encoding)
+        elif tag == "NAME":
+            transaction.payee = decode_value(text, encoding)
+        elif tag == "MEMO":
+            transaction.memo = decode_value(text, encoding)
+        elif tag == "TRNTYPE":
+            transaction.trntype = decode_value(text, encoding)
+
+def iter_file_transactions(file_name, account=None):
+    """Yield transactions of an ofx file, gzip or zstd compressed ones included"""
+    with open_ofx(file_name) as ofx_file:
+        for transaction in iter_transactions(ofx_file, account):
+            yield transaction
+
+def write_csv(transactions, output):
+    """Write transactions in utf-8 CSV"""
+    writer = csv.writer(output)
+    writer.writerow(Transaction.FIELDS)
+    for transaction in transactions:
+        writer.writerow([u"" if value is None else u"{}".format(value).encode("utf-8")
+                         for value in (getattr(transaction, field)
+                                       for field in Transaction.FIELDS)])
+
+def influxdb_lines(transactions, measurement="transaction", profile=None):
+    """Yield influxDB points of transactions
+    The FITID is a tag so transactions of the same day are distinct points
+    """
+    for transaction in transactions:
+        if transaction.date is None or transaction.amount is None:
+            continue
+        fields = [("amount", float(transaction.amount))]
+        if transaction.payee:
+            fields.append(("payee", transaction.payee))
+        if transaction.memo:
+            fields.append(("memo", transaction.memo))
+        yield make_line(measurement,
+                        [("account", transaction.account), ("type", transaction.trntype),
+                         ("fitid", transaction.fitid), ("profile", profile)],
+                        fields, calendar.timegm(transaction.date.timetuple()))
+
+def main():
+    """Export transactions of ofx files"""
+    parser = argparse.ArgumentParser(description='Export ofx transactions')
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument('-f', '--format', dest='format', required=False,
+                        choices=['csv', 'influxdb'], default='csv')
+    options = parser.parse_args()
+    transactions = (transaction for file_name in options.files
+                    for transaction in iter_file_transactions(file_name))
+    if options.format == "csv":
+        write_csv(transactions, sys.stdout)
+    else:
+        for line in influxdb_lines(transactions):
+            print "{}".format(line.encode("utf-8"))
+
+if __name__ == '__main__':
+    main()
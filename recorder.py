@@ -0,0 +1,323 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Record and replay HTTP traffic
+* Request/response pairs are written by a background thread
+  in rotating gzip compressed files of HAR entries, one JSON entry by line,
+  streamed responses are copied by chunks from a body file
+* Credentials and cookies are redacted, in responses too: the secure image,
+  secure phrase and questions of the login pages are never written
+* Recorded responses can be served again instead of the network,
+  redacted credentials are put back from the replaying profile
+
+Usage: recorder.py ARCHIVE
+       print the recorded requests of an archive file or directory
+"""
+
+import base64
+from collections import deque
+import datetime
+import glob
+import gzip
+from io import BytesIO
+import itertools
+import json
+import logging
+import os
+import Queue
+import re
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+import requests
+from requests.packages.urllib3.response import HTTPResponse
+
+REDACTED = "REDACTED"
+REDACTED_FIELDS = ("motDePasse", "codeUtilisateur", "valeurReponse")
+REDACTED_HEADERS = ("cookie", "set-cookie")
+LOGIN_PATH = "/identifiantunique/"
+# Stand-in of a streamed body in its JSON entry
+BODY_MARK = "@@BODY@@"
+SECURE_PHRASE_RE = re.compile(r"(<strong[^>]*>)(.*?)(</strong>)", re.DOTALL)
+QUESTION_RE = re.compile(r"(<label[^>]*valeurReponse[^>]*>\s*<b[^>]*>)(.*?)(</b>)", re.DOTALL)
+
+
+def redact_params(params):
+    """Return params as HAR name/value pairs without credentials"""
+    if not params:
+        return []
+    if isinstance(params, dict):
+        params = params.items()
+    return [{"name": name, "value": REDACTED if name in REDACTED_FIELDS else value}
+            for name, value in params]
+
+def redact_headers(headers):
+    """Return headers as HAR name/value pairs without cookies"""
+    return [{"name": name, "value": REDACTED if name.lower() in REDACTED_HEADERS else value}
+            for name, value in headers.items()]
+
+def to_bytes(value, encoding="utf-8"):
+    """Return value encoded, str values are utf-8"""
+    if isinstance(value, unicode):
+        return value.encode(encoding, "replace")
+    if encoding.lower().replace("-", "") != "utf8":
+        return value.decode("utf-8", "replace").encode(encoding, "replace")
+    return value
+
+def make_secrets(credentials):
+    """Return (placeholder, value) of the credentials found in pages"""
+    secrets = [("{REDACTED:secure_phrase}", credentials["secure_phrase"]),
+               ("{REDACTED:number}", credentials["number"]),
+               ("{REDACTED:password}", credentials["password"])]
+    for index, question in enumerate(sorted(credentials["questions"])):
+        secrets.append(("{REDACTED:question:%d}" % index, question))
+    return [(placeholder, value) for placeholder, value in secrets if value]
+
+def redact_content(path, content, content_type, secrets=()):
+    """Return a response body without the credentials of secrets
+    The secure image, secure phrase and questions of the login pages
+    are removed even when they are not the expected ones
+    """
+    if path.startswith(LOGIN_PATH):
+        if content_type.startswith("image/"):
+            return ""
+        placeholders = {}
+        for placeholder, value in secrets:
+            for encoding in ("utf-8", "cp1252"):
+                placeholders[to_bytes(value, encoding).strip()] = placeholder
+        content = SECURE_PHRASE_RE.sub(
+            lambda m: m.group(1) + "{REDACTED:secure_phrase}" + m.group(3), content)
+        content = QUESTION_RE.sub(
+            lambda m: m.group(1) + placeholders.get(m.group(2).strip(), REDACTED) +
+            m.group(3), content)
+    for placeholder, value in secrets:
+        for encoding in ("utf-8", "cp1252"):
+            content = content.replace(to_bytes(value, encoding), placeholder)
+    return content
+
+def redact_stream(body_file, secrets=(), chunk_size=64 * 1024):
+    """Yield the content of body_file without the credentials of secrets
+    The end of each chunk is kept for the next one, so no credential
+    spans two yielded chunks
+    """
+    values = [(placeholder, to_bytes(value, encoding))
+              for placeholder, value in secrets for encoding in ("utf-8", "cp1252")]
+    keep = max([len(value) for _, value in values] or [1]) - 1
+    buf = ""
+    while True:
+        chunk = body_file.read(chunk_size)
+        buf += chunk
+        for placeholder, value in values:
+            buf = buf.replace(value, placeholder)
+        if not chunk:
+            yield buf
+            return
+        if len(buf) > keep:
+            yield buf[:len(buf) - keep]
+            buf = buf[len(buf) - keep:]
+
+def encode_body(body_file, secrets=()):
+    """Yield the base64 encoded content of body_file without credentials"""
+    rest = ""
+    for chunk in redact_stream(body_file, secrets):
+        chunk = rest + chunk
+        cut = len(chunk) - len(chunk) % 3
+        rest = chunk[cut:]
+        yield base64.b64encode(chunk[:cut])
+    yield base64.b64encode(rest)
+
+def make_entry(method, host, path, params, data, res, step=None, secrets=(), content=None):
+    """Build a HAR entry of a request and its response
+    content defaults to the redacted content of res
+    """
+    if content is None:
+        content = redact_content(path.split("?", 1)[0], res.content,
+                                 res.headers.get("Content-Type", ""), secrets)
+    started = datetime.datetime.utcfromtimestamp(time.time() - res.elapsed.total_seconds())
+    return {"startedDateTime": started.isoformat() + "Z",
+            "time": round(res.elapsed.total_seconds() * 1000, 3),
+            "step": step,
+            "request": {"method": method.upper(),
+                        "host": host,
+                        "url": path.split("?", 1)[0],
+                        "queryString": redact_params(
+                            urlparse.parse_qsl(urlparse.urlsplit(path).query) +
+                            list((params or {}).items())),
+                        "postData": {"params": redact_params(data)},
+                        "headers": redact_headers(res.request.headers)},
+            "response": {"status": res.status_code,
+                         "headers": redact_headers(res.headers),
+                         "content": {"size": len(content),
+                                     "mimeType": res.headers.get("Content-Type", ""),
+                                     "encoding": "base64",
+                                     "text": base64.b64encode(content)}}}
+
+def read_archive(archive):
+    """Yield the entries of an archive file or of all archive files of a directory"""
+    if os.path.isdir(archive):
+        file_names = sorted(glob.glob(os.path.join(archive, "*.jsonl.gz")))
+    else:
+        file_names = [archive]
+    for file_name in file_names:
+        with gzip.open(file_name, "rb") as archive_file:
+            for line in archive_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class Recorder(object):
+    """Write HAR entries from a background thread
+    Entries are dropped rather than blocking requests when the queue is full
+    secrets are the make_secrets() credentials removed from responses
+    """
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024, max_files=5,
+                 queue_size=1000, secrets=(), logger=None):
+        self.directory = directory
+        self.secrets = secrets
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.logger = logger or logging.getLogger(__name__)
+        self.dropped = 0
+        self._queue = Queue.Queue(queue_size)
+        self._file = None
+        self._file_index = 0
+        self._written = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._thread = threading.Thread(target=self._run, name="recorder")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def body_file(self):
+        """Return a new file where the caller copies a streamed response"""
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix=".body-", delete=False)
+
+    def record(self, method, host, path, params, data, res, step=None, body_file=None):
+        """Queue a request and its response, never blocks
+        The content of streamed responses is read from the body_file file name,
+        which is removed once recorded
+        """
+        try:
+            self._queue.put_nowait((method, host, path, params, data, res, step, body_file))
+        except Queue.Full:
+            self.dropped += 1
+            if body_file is not None:
+                os.remove(body_file)
+
+    def _open(self):
+        """Open a new archive file and remove the oldest ones"""
+        self._file_index += 1
+        file_name = os.path.join(self.directory, "traffic-%s-%03d.jsonl.gz" % (
+            time.strftime("%Y%m%d%H%M%S"), self._file_index))
+        self._file = gzip.open(file_name, "wb")
+        self._written = 0
+        file_names = sorted(glob.glob(os.path.join(self.directory, "traffic-*.jsonl.gz")))
+        for old_file_name in file_names[:-self.max_files]:
+            os.remove(old_file_name)
+
+    def _write(self, method, host, path, params, data, res, step, body_file):
+        """Write the entry of a request, streamed bodies are copied by chunks"""
+        if body_file is None:
+            parts = [json.dumps(make_entry(method, host, path, params, data, res, step,
+                                           self.secrets)) + "\n"]
+            size = len(parts[0])
+        else:
+            entry = make_entry(method, host, path, params, data, res, step, content="")
+            entry["response"]["content"]["size"] = os.path.getsize(body_file)
+            entry["response"]["content"]["text"] = BODY_MARK
+            head, tail = (json.dumps(entry) + "\n").split(BODY_MARK)
+            raw_file = open(body_file, "rb")
+            parts = itertools.chain([head], encode_body(raw_file, self.secrets), [tail])
+            size = len(head) + len(tail) + os.path.getsize(body_file) * 4 / 3
+        if self._file is None or self._written + size > self.max_bytes:
+            if self._file is not None:
+                self._file.close()
+            self._open()
+        try:
+            for part in parts:
+                self._file.write(part)
+                self._written += len(part)
+        finally:
+            if body_file is not None:
+                raw_file.close()
+
+    def _run(self):
+        """Write queued entries until close() is called"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except (IOError, OSError, ValueError) as exp:
+                self.logger.error("Can not record %s: %s", item[2], exp)
+            finally:
+                if item[-1] is not None:
+                    os.remove(item[-1])
+        if self._file is not None:
+            self._file.close()
+
+    def close(self):
+        """Write queued entries and close the archive"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self.dropped:
+            self.logger.warning("%d request(s) not recorded, recorder queue full",
+                                self.dropped)
+
+
+class Replayer(object):
+    """Serve recorded responses by method, host and path in recorded order
+    The last response of a path is served again when its responses run out
+    Redacted credentials are replaced by the values of secrets
+    """
+    def __init__(self, archive, secrets=()):
+        self.secrets = secrets
+        self.entries = {}
+        for entry in read_archive(archive):
+            request = entry["request"]
+            key = (request["method"], request["host"], request["url"])
+            self.entries.setdefault(key, deque()).append(entry)
+        self._lock = threading.Lock()
+
+    def response(self, method, host, path, url=None):
+        """Return the next recorded response of a request"""
+        key = (method.upper(), host, path.split("?", 1)[0])
+        with self._lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise requests.ConnectionError("No recorded response for %s %s%s" % key)
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+        res = requests.Response()
+        res.status_code = entry["response"]["status"]
+        for header in entry["response"]["headers"]:
+            res.headers[header["name"]] = header["value"]
+        content = base64.b64decode(entry["response"]["content"]["text"])
+        encoding = requests.utils.get_encoding_from_headers(res.headers) or "utf-8"
+        for placeholder, value in self.secrets:
+            content = content.replace(placeholder, to_bytes(value, encoding))
+        res._content = content
+        res._content_consumed = True
+        res.raw = HTTPResponse(body=BytesIO(res._content), status=res.status_code,
+                               preload_content=False)
+        res.url = url or path
+        res.elapsed = datetime.timedelta(0)
+        return res
+
+
+def main():
+    """Print the recorded requests of an archive"""
+    if len(sys.argv) != 2:
+        print __doc__.split("Usage: ", 1)[-1]
+        sys.exit(1)
+    for entry in read_archive(sys.argv[1]):
+        print "{} {:4s} {} {}{} {} B".format(
+            entry["startedDateTime"], entry["request"]["method"],
+            entry["response"]["status"], entry["request"]["host"],
+            entry["request"]["url"], entry["response"]["content"]["size"])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Local transaction store
+* Transactions of ofx statements keyed by (account, FITID)
+* Balance snapshots of the account summary
+* Spending and balance history reports
+
+Usage: store.py DATABASE import FILE...
+       store.py DATABASE spend [-p day|month|year] [-a ACCOUNT] [--by-account]
+       store.py DATABASE balances [-a ACCOUNT]
+"""
+
+import argparse
+import sqlite3
+import time
+
+import ofx
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    account TEXT NOT NULL,
+    fitid TEXT NOT NULL,
+    date TEXT NOT NULL,
+    amount REAL NOT NULL,
+    payee TEXT,
+    memo TEXT,
+    trntype TEXT,
+    PRIMARY KEY (account, fitid)
+);
+CREATE INDEX IF NOT EXISTS transactions_date ON transactions (date);
+CREATE INDEX IF NOT EXISTS transactions_account_date ON transactions (account, date);
+CREATE INDEX IF NOT EXISTS transactions_amount ON transactions (amount);
+CREATE TABLE IF NOT EXISTS balances (
+    account TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    balance REAL NOT NULL,
+    fullname TEXT,
+    category TEXT,
+    caisse TEXT,
+    PRIMARY KEY (account, timestamp)
+);
+"""
+
+PERIODS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+
+class TransactionStore(object):
+    """SQLite store of transactions and balances"""
+    def __init__(self, file_name):
+        self.db = sqlite3.connect(file_name)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def add_transactions(self, transactions):
+        """Insert or update transactions in one database transaction
+        transactions can be a generator, e.g. ofx.iter_file_transactions
+        Return the number of new transactions
+        """
+        rows = ((transaction.account, transaction.fitid, transaction.date.isoformat(),
+                 float(transaction.amount), transaction.payee, transaction.memo,
+                 transaction.trntype)
+                for transaction in transactions
+                if transaction.date is not None and transaction.amount is not None)
+        with self.db:
+            before = self.db.execute("SELECT count(*) FROM transactions").fetchone()[0]
+            self.db.executemany("INSERT OR REPLACE INTO transactions "
+                                "(account, fitid, date, amount, payee, memo, trntype) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            after = self.db.execute("SELECT count(*) FROM transactions").fetchone()[0]
+        return after - before
+
+    def add_file(self, file_name):
+        """Add transactions of an ofx file, return the number of new transactions"""
+        return self.add_transactions(ofx.iter_file_transactions(file_name))
+
+    def add_balances(self, accounts, timestamp):
+        """Add a balance snapshot of get_accounts() accounts"""
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO balances "
+                                "(account, timestamp, balance, fullname, category, caisse) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                [(account["id"], int(timestamp), account["balance"],
+                                  account.get("fullname"), account.get("category"),
+                                  account.get("caisse"))
+                                 for account in accounts])
+
+    def spend(self, period="month", account=None, by_account=False):
+        """Return (period, account, debits, credits, count) rows
+        account is None unless by_account is set
+        """
+        group = "account" if by_account else "NULL"
+        query = ("SELECT strftime(?, date) AS period, {} AS acc, "
+                 "sum(CASE WHEN amount < 0 THEN -amount ELSE 0 END), "
+                 "sum(CASE WHEN amount > 0 THEN amount ELSE 0 END), count(*) "
+                 "FROM transactions".format(group))
+        params = [PERIODS[period]]
+        if account is not None:
+            query += " WHERE account = ?"
+            params.append(account)
+        query += " GROUP BY period, acc ORDER BY period, acc"
+        return self.db.execute(query, params).fetchall()
+
+    def balance_history(self, account=None):
+        """Return (timestamp, account, fullname, balance) rows"""
+        query = "SELECT timestamp, account, fullname, balance FROM balances"
+        params = []
+        if account is not None:
+            query += " WHERE account = ?"
+            params.append(account)
+        query += " ORDER BY account, timestamp"
+        return self.db.execute(query, params).fetchall()
+
+    def close(self):
+        """Close the database"""
+        self.db.close()
+
+
+def get_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Query the local transaction store')
+    parser.add_argument('database')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_import = subparsers.add_parser('import', help="Add ofx files")
+    parser_import.add_argument('files', nargs='+', metavar='FILE')
+    parser_spend = subparsers.add_parser('spend', help="Spending by period")
+    parser_spend.add_argument('-p', '--period', dest='period', required=False,
+                              choices=sorted(PERIODS), default='month')
+    parser_spend.add_argument('-a', '--account', dest='account', required=False)
+    parser_spend.add_argument('--by-account', dest='by_account', required=False,
+                              action='store_true', default=False)
+    parser_balances = subparsers.add_parser('balances', help="Balance history")
+    parser_balances.add_argument('-a', '--account', dest='account', required=False)
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    options = get_args()
+    store = TransactionStore(options.database)
+    if options.command == "import":
+        for file_name in options.files:
+            print "{}: {} new transaction(s)".format(file_name, store.add_file(file_name))
+    elif options.command == "spend":
+        print "{:10s} {:20s} {:>12s} {:>12s} {:>6s}".format(
+            "period", "account", "debits", "credits", "count")
+        for period, account, debits, credits, count in store.spend(
+                options.period, options.account, options.by_account):
+            print "{:10s} {:20s} {:12.2f} {:12.2f} {:6d}".format(
+                period, account or "", debits, credits, count)
+    else:
+        for timestamp, account, fullname, balance in store.balance_history(options.account):
+            print u"{} {:20s} {:12.2f} {}".format(
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp)),
+                account, balance, fullname or "").encode("utf-8")
+    store.close()
+
+if __name__ == '__main__':
+    main()